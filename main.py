@@ -2,17 +2,26 @@ import streamlit as st
 import sqlite3
 import re  # 正規表現用
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import hashlib
+import secrets
 import os
-from PIL import Image
+from PIL import Image, features
 import base64
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
 import json
 import zipfile
-from io import BytesIO
 import tempfile
 import shutil
+import threading
+import time
+import atexit
+import html
+import unicodedata
+import functools
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 # リッチテキストエディタのインポート
@@ -30,73 +39,388 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-def save_session_to_db(user_id, session_data):
-    """セッション情報をデータベースに保存"""
-    try:
-        conn = sqlite3.connect('medical_ct.db')
-        cursor = conn.cursor()
-        
-        # セッションテーブルが存在しない場合は作成
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                user_id INTEGER PRIMARY KEY,
-                session_data TEXT,
-                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        session_json = json.dumps(session_data)
-        cursor.execute('''
-            INSERT OR REPLACE INTO user_sessions (user_id, session_data, last_updated)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-        ''', (user_id, session_json))
-        
-        conn.commit()
-        print(f"セッション保存成功: ユーザーID={user_id}, データ={session_json}")  # デバッグ
-        conn.close()
-        return True
-    except Exception as e:
-        return False
+# データベース接続管理
+DB_PATH = 'medical_ct.db'
+
+# SQLiteストレージプロファイル（環境変数 CT_DB_PROFILE で選択）
+#   standard         : SQLite既定に近い設定。ロールバックジャーナルのため書き込み中は読み取りが待たされる
+#   high-concurrency : 参照と編集が同時に発生する運用向け（既定）
+#                      - WAL: 読み取りが書き込みをブロックせず、書き込みも読み取りを待たない
+#                      - busy_timeout: ロック競合時に即エラーにせず最大10秒待機
+#                      - synchronous=NORMAL: WALでは破損の心配がなく、コミットごとのfsyncを削減
+#                      - mmap_size / cache_size: 読み取りをメモリマップとページキャッシュで高速化
+DB_PROFILES = {
+    'standard': {
+        'journal_mode': 'DELETE',
+        'busy_timeout': 5000,       # ミリ秒
+        'synchronous': 'FULL',
+        'mmap_size': 0,             # バイト（0で無効）
+        'cache_size': -2000,        # 負値はKiB単位（約2MB）
+    },
+    'high-concurrency': {
+        'journal_mode': 'WAL',
+        'busy_timeout': 10000,
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,   # 約64MB
+    },
+}
+DEFAULT_DB_PROFILE = 'high-concurrency'
+DB_PROFILE_NAME = os.environ.get('CT_DB_PROFILE', DEFAULT_DB_PROFILE)
+if DB_PROFILE_NAME not in DB_PROFILES:
+    DB_PROFILE_NAME = DEFAULT_DB_PROFILE
+
+def get_db_profile():
+    """現在のストレージプロファイル設定を取得"""
+    return DB_PROFILES[DB_PROFILE_NAME]
+
+# プロセス内で共有するオブジェクト
+# Streamlitは再実行のたびにスクリプト全体を評価し直すため、モジュール変数は再実行をまたいで残らない。
+# キャッシュやロックなど、プロセス全体で1つだけ持つべきものはここから取得する
+@st.cache_resource
+def _process_resources():
+    """プロセス共有オブジェクトの格納先を取得"""
+    return {}, threading.Lock()
+
+def process_resource(name, factory):
+    """プロセス内で共有するオブジェクトを取得（初回のみfactory()で作成）"""
+    resources, lock = _process_resources()
+    with lock:
+        if name not in resources:
+            resources[name] = factory()
+        return resources[name]
 
-def load_session_from_db():
-    """データベースからセッション情報を復元"""
+# 接続プール
+# Streamlitは再実行のたびに新しいスレッドでスクリプトを実行するため、接続をスレッドに結び付けると
+# クリックのたびに接続とPRAGMAの設定をやり直すことになる。接続はプロセス全体のプールに保持し、
+# スレッドは最初にDBを使うときに1本借りて、再実行の終わりにrelease_db_connection()でプールへ返す
+# （セッション書き込みなどのバックグラウンドスレッドは借りた接続を使い続ける）
+DB_POOL_MAX_IDLE = 8  # プールに残す未使用の接続の最大数（超えた分は閉じる）
+_db_pool = process_resource('db_pool', list)
+_db_pool_lock = process_resource('db_pool_lock', threading.Lock)
+_db_local = process_resource('db_local', threading.local)
+
+def _configure_connection(conn):
+    """新規接続に共通のPRAGMAを適用（接続ごとに一度だけ）"""
+    profile = get_db_profile()
+    conn.execute(f"PRAGMA busy_timeout = {int(profile['busy_timeout'])}")
+    conn.execute(f"PRAGMA synchronous = {profile['synchronous']}")
+    conn.execute(f"PRAGMA mmap_size = {int(profile['mmap_size'])}")
+    conn.execute(f"PRAGMA cache_size = {int(profile['cache_size'])}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    register_search_functions(conn)
+
+def get_db_connection():
+    """現在のスレッドが借りているDB接続を取得（なければプールから借り、プールが空の場合のみ接続・設定）"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        with _db_pool_lock:
+            conn = _db_pool.pop() if _db_pool else None
+        if conn is None:
+            # 再実行ごとに別のスレッドが使うため、スレッドの確認を無効にする（同時に使うのは借りた1スレッドのみ）
+            conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+            _configure_connection(conn)
+        _db_local.conn = conn
+        _db_local.depth = 0
+        _db_local.invalidate = False
+    return conn
+
+def release_db_connection():
+    """現在のスレッドが借りているDB接続をプールに返す（未確定のトランザクションは取り消す）"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        return
+    _db_local.conn = None
+    conn.rollback()
+    with _db_pool_lock:
+        if len(_db_pool) < DB_POOL_MAX_IDLE:
+            _db_pool.append(conn)
+            return
+    conn.close()
+
+@contextmanager
+def db_transaction(invalidate_cache=True):
+    """書き込み用トランザクション（正常終了でcommit、例外発生時はrollback）
+
+    入れ子で呼び出された場合は最も外側のブロックでのみcommitする。
+    セッション情報などキャッシュ対象外のテーブルのみを更新する場合は invalidate_cache=False を指定する。
+    """
+    conn = get_db_connection()
+    _db_local.depth += 1
     try:
-        conn = sqlite3.connect('medical_ct.db')
-        cursor = conn.cursor()
+        yield conn.cursor()
+        if _db_local.depth == 1:
+            conn.commit()
+            if invalidate_cache or _db_local.invalidate:
+                bump_data_version()
+            _db_local.invalidate = False
+        elif invalidate_cache:
+            _db_local.invalidate = True
+    except Exception:
+        if _db_local.depth == 1:
+            conn.rollback()
+            _db_local.invalidate = False
+        raise
+    finally:
+        _db_local.depth -= 1
+
+# クエリ結果キャッシュ
+# 書き込みトランザクションがcommitされるたびにデータバージョンを進め、
+# 古いバージョンで取得した結果は再利用しない（編集内容は次の再実行で即座に反映される）
+QUERY_CACHE_MAX_ENTRIES = 256
+_query_cache = process_resource('query_cache', OrderedDict)
+_query_cache_lock = process_resource('query_cache_lock', threading.Lock)
+_data_version = process_resource('data_version', lambda: {'value': 0})
+
+def get_data_version():
+    """現在のデータバージョンを取得"""
+    return _data_version['value']
+
+def bump_data_version():
+    """データバージョンを進めてキャッシュを無効化"""
+    with _query_cache_lock:
+        _data_version['value'] += 1
+        _query_cache.clear()
+
+def _copy_query_result(result):
+    """キャッシュした結果の複製を作成（DataFrameは変更可能なため、呼び出し側には複製を返す）"""
+    if isinstance(result, pd.DataFrame):
+        return result.copy()
+    if isinstance(result, dict):
+        return {key: _copy_query_result(value) for key, value in result.items()}
+    return result
+
+def cached_query(func):
+    """引数とデータバージョンをキーにクエリ結果をキャッシュするデコレーター
+
+    結果は全セッションで共有されるため、キャッシュには元の結果を保持し、呼び出し側には複製を返す。
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        version = get_data_version()
+        with _query_cache_lock:
+            entry = _query_cache.get(key)
+            if entry is not None and entry[0] == version:
+                _query_cache.move_to_end(key)
+                return _copy_query_result(entry[1])
+        
+        result = func(*args, **kwargs)
+        
+        with _query_cache_lock:
+            _query_cache[key] = (version, result)
+            _query_cache.move_to_end(key)
+            while len(_query_cache) > QUERY_CACHE_MAX_ENTRIES:
+                _query_cache.popitem(last=False)
+        return _copy_query_result(result)
+    return wrapper
+
+def apply_storage_profile():
+    """ジャーナルモードをデータベースファイルに設定（WALはファイルに永続化される）"""
+    conn = get_db_connection()
+    journal_mode = get_db_profile()['journal_mode']
+    current = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    if current.upper() != journal_mode.upper():
+        conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+
+def get_db_settings():
+    """現在の接続で有効なストレージ設定を取得（管理画面表示用）"""
+    conn = get_db_connection()
+    synchronous_names = {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'}
+    synchronous = conn.execute("PRAGMA synchronous").fetchone()[0]
+    return {
+        'profile': DB_PROFILE_NAME,
+        'journal_mode': conn.execute("PRAGMA journal_mode").fetchone()[0],
+        'busy_timeout': conn.execute("PRAGMA busy_timeout").fetchone()[0],
+        'synchronous': synchronous_names.get(synchronous, str(synchronous)),
+        'mmap_size': conn.execute("PRAGMA mmap_size").fetchone()[0],
+        'cache_size': conn.execute("PRAGMA cache_size").fetchone()[0],
+        'schema_version': get_schema_version(),
+    }
+
+# セッション情報
+# ブラウザごとにランダムなトークンを発行してCookieに持たせ、
+# user_sessionsはトークンを主キーとして1回の検索で引く。有効期限はアクセスのたびに延長する
+# URLに載せると履歴・共有リンク・Refererからトークンが漏れるため、クエリパラメータには置かない
+SESSION_COOKIE_NAME = 'ct_session'
+LEGACY_SESSION_QUERY_PARAM = 'session'  # 以前のバージョンがURLに付けていたパラメータ（読み取らずに削除する）
+SESSION_TTL_SECONDS = 24 * 60 * 60
+SESSION_PURGE_INTERVAL = 60 * 60  # 期限切れセッションを削除する間隔（秒）
+
+# 書き込みはwrite-behindで行う。ページ表示のたびに書き込むと編集処理と書き込みロックを奪い合うため、
+# 更新はメモリ上でトークンごとに最新の1件にまとめ、バックグラウンドスレッドが一定間隔でまとめて書き込む
+SESSION_FLUSH_INTERVAL = 5  # 秒
+SESSION_REFRESH_INTERVAL = 300  # 内容が変わらなくても、この秒数ごとに最終更新日時・有効期限を更新する
+_session_writes = process_resource('session_writes', lambda: {'pending': {}, 'saved': {}})
+_session_writes_lock = process_resource('session_writes_lock', threading.Lock)
+_session_flush_lock = process_resource('session_flush_lock', threading.Lock)
+
+def _session_timestamp(offset_seconds=0):
+    """セッション用の日時文字列を取得（CURRENT_TIMESTAMPと同じ形式、UTC）"""
+    return datetime.fromtimestamp(time.time() + offset_seconds, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def create_session_token():
+    """新しいセッショントークンを発行"""
+    return secrets.token_urlsafe(32)
+
+def get_session_cookie():
+    """ブラウザから送られたセッションCookieの値を取得（なければNone）
+
+    st.context.cookiesは接続時のリクエストの内容なので、ログイン後に設定したCookieは次回の接続から送られる。
+    """
+    return st.context.cookies.get(SESSION_COOKIE_NAME)
+
+def sync_session_cookie():
+    """セッションCookieを現在のセッショントークンに合わせる
+
+    Streamlitのサーバー側からはCookieを設定できないため、ブラウザ側のスクリプトで document.cookie を書き換える。
+    トークンがない場合（ログアウト後など）はCookieを削除する。Cookieの有効期限は指定せず、
+    ログイン状態の有効期限はuser_sessions側（SESSION_TTL_SECONDS）で管理する。
+    st.context.cookiesは接続時の値のまま変わらないため、最後に書き込んだ値をセッション状態に記録し、
+    値が変わったときだけスクリプトを出力する。
+    """
+    token = st.session_state.get('session_token')
+    if token == st.session_state.get('session_cookie_written', get_session_cookie()):
+        return
+    if token:
+        cookie = f"{SESSION_COOKIE_NAME}={token}; Path=/; SameSite=Strict"
+    else:
+        cookie = f"{SESSION_COOKIE_NAME}=; Path=/; Max-Age=0; SameSite=Strict"
+    st.html(
+        "<script>"
+        f"document.cookie = {json.dumps(cookie)} + (location.protocol === 'https:' ? '; Secure' : '');"
+        "</script>",
+        unsafe_allow_javascript=True,
+    )
+    st.session_state.session_cookie_written = token
+
+def save_session_to_db(token, user_id, session_data, flush=False):
+    """セッション情報を書き込み待ちに追加（flush=Trueの場合はその場で書き込む）
+
+    内容が保存済みのものと同じで、最終更新からSESSION_REFRESH_INTERVAL秒以内の場合は何もしない。
+    """
+    session_json = json.dumps(session_data)
+    entry = (user_id, session_json, _session_timestamp(), _session_timestamp(SESSION_TTL_SECONDS))
+    with _session_writes_lock:
+        saved = _session_writes['saved'].get(token)
+        unchanged = saved is not None and saved[0] == session_json and time.time() - saved[1] < SESSION_REFRESH_INTERVAL
+        if token in _session_writes['pending'] or not unchanged:
+            _session_writes['pending'][token] = entry
+    
+    if flush:
+        return flush_session_writes() is not None
+    process_resource('session_flusher', _start_session_flusher)
+    return True
+
+def flush_session_writes():
+    """書き込み待ちのセッション情報を1回のトランザクションでまとめて書き込む
+
+    書き込んだ件数を返す（失敗時はNone。失敗した分は書き込み待ちに戻す）。
+    """
+    with _session_flush_lock:
+        with _session_writes_lock:
+            pending = _session_writes['pending']
+            _session_writes['pending'] = {}
+        if not pending:
+            return 0
         
-        # セッションテーブルが存在するかチェック
-        cursor.execute('''
-            SELECT name FROM sqlite_master WHERE type='table' AND name='user_sessions'
-        ''')
-        if not cursor.fetchone():
-            conn.close()
+        try:
+            with db_transaction(invalidate_cache=False) as cursor:
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO user_sessions (token, user_id, session_data, last_updated, expires_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [(token, *entry) for token, entry in pending.items()])
+        except Exception:
+            with _session_writes_lock:
+                for token, entry in pending.items():
+                    _session_writes['pending'].setdefault(token, entry)
             return None
         
-        # 最新のセッション情報を取得（過去24時間以内）
-        cursor.execute('''
-            SELECT user_id, session_data FROM user_sessions
-            WHERE datetime(last_updated) > datetime('now', '-1 day')
-            ORDER BY last_updated DESC LIMIT 1
-        ''')
+        flushed_at = time.time()
+        with _session_writes_lock:
+            for token, (_, session_json, _, _) in pending.items():
+                _session_writes['saved'][token] = (session_json, flushed_at)
+        return len(pending)
+
+# セッション関連のSQL（get_query_plan_checksでも同じものを確認する）
+SESSION_LOAD_SQL = "SELECT user_id, session_data FROM user_sessions WHERE token = ? AND expires_at > ?"
+SESSION_PURGE_SQL = "DELETE FROM user_sessions WHERE expires_at <= ?"
+USER_BY_ID_SQL = "SELECT id, name, email FROM users WHERE id = ?"
+
+def purge_expired_sessions():
+    """有効期限切れのセッションを削除（expires_atのインデックスを使用）"""
+    expired_before = _session_timestamp()
+    with _session_flush_lock:
+        with db_transaction(invalidate_cache=False) as cursor:
+            cursor.execute(SESSION_PURGE_SQL, (expired_before,))
+            purged = cursor.rowcount
+        with _session_writes_lock:
+            # メモリ上の保存記録も、一定時間更新のないものは破棄する
+            stale_before = time.time() - SESSION_TTL_SECONDS
+            for token in [t for t, (_, saved_at) in _session_writes['saved'].items() if saved_at < stale_before]:
+                del _session_writes['saved'][token]
+    return purged
+
+def _session_flush_loop():
+    """一定間隔で書き込み待ちのセッション情報を書き込み、期限切れのセッションを削除する（バックグラウンドスレッド）"""
+    last_purge = 0
+    while True:
+        time.sleep(SESSION_FLUSH_INTERVAL)
+        flush_session_writes()
+        if time.time() - last_purge >= SESSION_PURGE_INTERVAL:
+            try:
+                purge_expired_sessions()
+            except Exception:
+                pass
+            last_purge = time.time()
+
+def _start_session_flusher():
+    """セッション書き込み用のバックグラウンドスレッドを開始（プロセス終了時にも書き込む）"""
+    thread = threading.Thread(target=_session_flush_loop, name='session-flusher', daemon=True)
+    thread.start()
+    atexit.register(flush_session_writes)
+    return thread
+
+def delete_session_from_db(token):
+    """セッション情報を削除（書き込み待ちの更新も破棄する）"""
+    with _session_flush_lock:
+        with _session_writes_lock:
+            _session_writes['pending'].pop(token, None)
+            _session_writes['saved'].pop(token, None)
+        try:
+            with db_transaction(invalidate_cache=False) as cursor:
+                cursor.execute('DELETE FROM user_sessions WHERE token = ?', (token,))
+        except Exception:
+            pass
+
+def load_session_from_db(token):
+    """トークンに対応する有効なセッション情報を復元"""
+    if not token:
+        return None
+    try:
+        with _session_writes_lock:
+            pending = _session_writes['pending'].get(token)
+        if pending:
+            user_id, session_json = pending[0], pending[1]
+        else:
+            result = get_db_connection().execute(SESSION_LOAD_SQL, (token, _session_timestamp())).fetchone()
+            if not result:
+                return None
+            user_id, session_json = result
         
-        result = cursor.fetchone()
-        conn.close()
+        session_data = json.loads(session_json)
         
-        if result:
-            user_id, session_json = result
-            session_data = json.loads(session_json)
-            
-            # ユーザー情報が有効かチェック
-            user = get_user_by_id(user_id)
-            if user:
-                return {
-                    'user': {
-                        'id': user[0],
-                        'name': user[1],
-                        'email': user[2]
-                    },
-                    'page': session_data.get('page', 'home')
-                }
+        # ユーザー情報が有効かチェック
+        user = get_user_by_id(user_id)
+        if user:
+            return {
+                'user': {
+                    'id': user[0],
+                    'name': user[1],
+                    'email': user[2]
+                },
+                'page': session_data.get('page', 'home')
+            }
         
         return None
     except Exception as e:
@@ -105,22 +429,18 @@ def load_session_from_db():
 def get_user_by_id(user_id):
     """IDでユーザー情報を取得"""
     try:
-        conn = sqlite3.connect('medical_ct.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, email FROM users WHERE id = ?", (user_id,))
-        user = cursor.fetchone()
-        conn.close()
-        return user
+        conn = get_db_connection()
+        return conn.execute(USER_BY_ID_SQL, (user_id,)).fetchone()
     except:
         return None
 
 def update_session_in_db():
-    """現在のセッション状態をデータベースに更新"""
-    if 'user' in st.session_state:
+    """現在のセッション状態をデータベースに更新（書き込みはまとめて非同期に行う）"""
+    if 'user' in st.session_state and st.session_state.get('session_token'):
         session_data = {
             'page': st.session_state.get('page', 'home')
         }
-        save_session_to_db(st.session_state.user['id'], session_data)
+        save_session_to_db(st.session_state.session_token, st.session_state.user['id'], session_data)
 
 # カスタムCSS
 st.markdown("""
@@ -252,101 +572,233 @@ def display_rich_content(content):
         st.info("内容が設定されていません")
 
 # 画像処理関数
-def resize_image(image, max_size=(600, 400)):
+# アップロード時に生成する画像サイズ（名前: 最大サイズ）。大きい順に並べる
+# fullが画像ストアの本体、それ以外は表示幅に応じて使い分ける縮小版
+IMAGE_RENDITIONS = {
+    'full': (600, 400),
+    'display': (400, 300),
+    'thumb': (200, 150),
+}
+
+def resize_image(image, max_size=IMAGE_RENDITIONS['full'], resample=Image.Resampling.LANCZOS):
     """画像をリサイズして容量を削減"""
     if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
-        image.thumbnail(max_size, Image.Resampling.LANCZOS)
+        image.thumbnail(max_size, resample)
     return image
 
-def image_to_base64(uploaded_file):
-    """アップロードファイルをBase64文字列に変換"""
-    try:
-        image = Image.open(uploaded_file)
-        resized_image = resize_image(image.copy())
-        
-        if resized_image.mode == 'RGBA':
-            rgb_image = Image.new('RGB', resized_image.size, (255, 255, 255))
-            rgb_image.paste(resized_image, mask=resized_image.split()[-1])
-            resized_image = rgb_image
-        elif resized_image.mode not in ['RGB', 'L']:
-            resized_image = resized_image.convert('RGB')
-        
-        buffered = BytesIO()
-        resized_image.save(buffered, format="JPEG", quality=50, optimize=True)
-        img_str = base64.b64encode(buffered.getvalue()).decode()
-        
-        if len(img_str) > 500000:  # 500KB
-            buffered = BytesIO()
-            resized_image.save(buffered, format="JPEG", quality=30, optimize=True)
-            img_str = base64.b64encode(buffered.getvalue()).decode()
-        
-        return img_str
-    except Exception as e:
-        st.error(f"画像の変換に失敗しました: {str(e)}")
-        return None
+def _to_jpeg_mode(image):
+    """JPEGで保存できるモード（RGB/L）に変換（透過部分は白で塗りつぶす）"""
+    if image.mode == 'RGBA':
+        rgb_image = Image.new('RGB', image.size, (255, 255, 255))
+        rgb_image.paste(image, mask=image.split()[-1])
+        return rgb_image
+    if image.mode not in ['RGB', 'L']:
+        return image.convert('RGB')
+    return image
 
-def base64_to_image(base64_str):
-    """Base64文字列をPIL Imageに変換"""
-    if base64_str:
-        try:
-            image_data = base64.b64decode(base64_str)
-            return Image.open(BytesIO(image_data))
-        except Exception as e:
-            st.error(f"画像データの読み込みに失敗しました: {str(e)}")
-            return None
-    return None
+# 画像エンコード設定
+# fullサイズの目標容量（縮小版は画素数に比例して小さくする）と品質の探索範囲
+# 既定値の48KBは、従来の固定品質50で保存していた600x400の画像より小さくなるように設定している。
+# 文字の多いスクリーンショットがつぶれないよう、最低品質は従来の再エンコード時の30より高くする
+IMAGE_BYTE_BUDGET = int(os.environ.get('CT_IMAGE_BUDGET_KB', '48')) * 1024
+IMAGE_QUALITY_MAX = 50
+IMAGE_QUALITY_MIN = 40
+IMAGE_ENCODE_MAX_PASSES = 4
+
+def _image_format():
+    """保存形式を取得（環境変数 CT_IMAGE_FORMAT=WEBP でWebP、既定はJPEG）"""
+    image_format = os.environ.get('CT_IMAGE_FORMAT', 'JPEG').upper()
+    if image_format == 'WEBP' and features.check('webp'):
+        return 'WEBP'
+    return 'JPEG'
 
-def display_image_with_caption(base64_str, caption="", width=300):
-    """Base64画像を表示"""
-    if base64_str:
+IMAGE_FORMAT = _image_format()
+
+def _encode(image, quality, image_format, optimize=True):
+    """指定した品質で画像をエンコード（optimize=FalseはJPEGのハフマン表の最適化を省く）"""
+    buffered = BytesIO()
+    if image_format == 'WEBP':
+        image.save(buffered, format="WEBP", quality=quality, method=4)
+    else:
+        image.save(buffered, format="JPEG", quality=quality, optimize=optimize)
+    return buffered.getvalue()
+
+def encode_image(image, budget=IMAGE_BYTE_BUDGET, image_format=None):
+    """目標容量に収まる最も高い品質で画像をエンコード
+
+    まず最高品質でエンコードし、収まらなければ容量が品質にほぼ比例するとして
+    初回の容量から品質を見積もり、その前後を二分探索する（最大IMAGE_ENCODE_MAX_PASSES回）。
+    探索中はハフマン表の最適化を省いて軽くエンコードし（最適化しても容量は少し小さくなるだけなので、
+    収まった品質は最適化後も収まる）、決まった品質で一度だけ最適化してエンコードする。
+    最低品質でも収まらない場合は最低品質の結果を返す。
+    """
+    image_format = image_format or IMAGE_FORMAT
+    image_bytes = _encode(image, IMAGE_QUALITY_MAX, image_format)
+    if len(image_bytes) <= budget:
+        return image_bytes
+    
+    size = len(image_bytes)
+    best = IMAGE_QUALITY_MIN
+    low, high = IMAGE_QUALITY_MIN, IMAGE_QUALITY_MAX - 1
+    quality = max(low, min(high, IMAGE_QUALITY_MAX * budget // size))
+    for _ in range(IMAGE_ENCODE_MAX_PASSES):
+        if len(_encode(image, quality, image_format, optimize=False)) <= budget:
+            best = quality
+            low = quality + 1
+        else:
+            high = quality - 1
+        if low > high:
+            break
+        quality = (low + high) // 2
+    
+    return _encode(image, best, image_format)
+
+def _rendition_budget(image):
+    """画素数に応じた目標容量を計算（fullサイズでIMAGE_BYTE_BUDGET）"""
+    full_width, full_height = IMAGE_RENDITIONS['full']
+    ratio = (image.size[0] * image.size[1]) / (full_width * full_height)
+    return max(4 * 1024, int(IMAGE_BYTE_BUDGET * min(1.0, ratio)))
+
+def decode_for_renditions(image):
+    """開いた画像をfullサイズ生成に必要な解像度でデコード
+
+    JPEGはdraftモードでDCTの段階で1/2〜1/8に縮小しながらデコードするため、
+    大きなスキャン画像でも元の解像度の画素を展開しない。破損した画像はここで例外になる。
+    """
+    if image.format == 'JPEG':
+        image.draft(None, IMAGE_RENDITIONS['full'])
+    image.load()
+    return image
+
+def create_image_renditions(image):
+    """デコード済みの画像からIMAGE_RENDITIONSの各サイズの画像を生成
+
+    戻り値は {レンディション名: 画像のバイト列}（形式はIMAGE_FORMAT）。元画像より大きい縮小版は作らない。
+    ワーカースレッドからも呼ばれるため、Streamlitの関数は使わない（失敗時は例外）。
+    imageはその場で縮小されるため、呼び出し側で再利用しないこと。
+    """
+    current = _to_jpeg_mode(resize_image(image, IMAGE_RENDITIONS['full']))
+    renditions = {'full': encode_image(current, _rendition_budget(current))}
+    
+    # 縮小版は一つ前のサイズから順に縮小する（大きな元画像を何度も縮小しない）
+    # 縮小率が小さいため、LANCZOSより軽いBICUBICで十分
+    for name, max_size in list(IMAGE_RENDITIONS.items())[1:]:
+        if current.size[0] <= max_size[0] and current.size[1] <= max_size[1]:
+            break
+        current = resize_image(current.copy(), max_size, Image.Resampling.BICUBIC)
+        renditions[name] = encode_image(current, _rendition_budget(current))
+    
+    return renditions
+
+def display_image_with_caption(image_value, caption="", width=300):
+    """画像を表示（画像ストアの参照または旧形式のBase64文字列）
+
+    表示幅を満たす最小のレンディションを選び、バイト列をそのままst.imageに渡す。
+    """
+    if image_value:
         try:
-            image = base64_to_image(base64_str)
-            if image:
-                st.image(image, caption=caption, width=width)
+            image_bytes = load_image_data(image_value, width=width)
+            if image_bytes:
+                st.image(image_bytes, caption=caption, width=width)
             else:
                 st.warning("画像の表示に失敗しました")
         except Exception as e:
             st.error(f"画像の表示に失敗しました: {str(e)}")
 
-def validate_and_process_image(uploaded_file):
-    """アップロードされた画像ファイルを検証・処理"""
+def show_lazy_sick_image(sick_id, column, label, caption):
+    """疾患画像を「画像を表示」がオンのときだけ読み込んで表示"""
+    st.markdown(f"**{label}:**")
+    if st.toggle("画像を表示", key=f"detail_show_{sick_id}_{column}"):
+        display_image_with_caption(get_sick_image(sick_id, column), caption)
+
+def process_image_upload(uploaded_file):
+    """アップロードされた画像ファイルを検証・処理（ワーカースレッドから呼べる）
+
+    戻り値は (レンディション辞書またはNone, メッセージ, 警告のリスト)。
+    """
+    warnings = []
     if uploaded_file is None:
-        return None, "ファイルが選択されていません"
+        return None, "ファイルが選択されていません", warnings
     
     if uploaded_file.size > 5 * 1024 * 1024:  # 5MB
-        return None, "ファイルサイズが5MBを超えています。より小さなファイルを選択してください。"
+        return None, "ファイルサイズが5MBを超えています。より小さなファイルを選択してください。", warnings
     
     allowed_types = ['image/png', 'image/jpeg', 'image/jpg']
     if uploaded_file.type not in allowed_types:
-        return None, "対応していないファイル形式です（PNG、JPEG、JPGのみ対応）"
+        return None, "対応していないファイル形式です（PNG、JPEG、JPGのみ対応）", warnings
     
+    # 画像は一度だけ開いてデコードする（検証はヘッダーの確認とデコードの成否で行う）
     try:
-        test_image = Image.open(uploaded_file)
-        
-        if test_image.mode not in ['RGB', 'RGBA', 'L', 'P']:
-            return None, f"対応していない画像モードです: {test_image.mode}"
-        
-        if test_image.size[0] > 2000 or test_image.size[1] > 2000:
-            st.warning("画像サイズが大きいため、自動的にリサイズされます")
-        
-        test_image.verify()
-        uploaded_file.seek(0)
+        image = Image.open(uploaded_file)
         
-        base64_str = image_to_base64(uploaded_file)
-        if base64_str is None:
-            return None, "画像の変換に失敗しました"
+        if image.mode not in ['RGB', 'RGBA', 'L', 'P']:
+            return None, f"対応していない画像モードです: {image.mode}", warnings
         
-        return base64_str, "OK"
+        if image.size[0] > 2000 or image.size[1] > 2000:
+            warnings.append("画像サイズが大きいため、自動的にリサイズされます")
         
+        decode_for_renditions(image)
+    except Exception as e:
+        return None, f"無効な画像ファイルです: {str(e)}", warnings
+    
+    try:
+        renditions = create_image_renditions(image)
     except Exception as e:
-        return None, f"無効な画像ファイルです: {str(e)}"
+        return None, f"画像の変換に失敗しました: {str(e)}", warnings
+    
+    return renditions, "OK", warnings
+
+def validate_and_process_image(uploaded_file):
+    """アップロードされた画像ファイルを検証・処理
+
+    成功時は {レンディション名: 画像のバイト列} を返す（add_*/update_* にそのまま渡せる）。
+    """
+    image_data, message, warnings = process_image_upload(uploaded_file)
+    for warning in warnings:
+        st.warning(warning)
+    return image_data, message
+
+# 画像処理用のスレッドプール（全セッションで共有し、同時に処理する画像数を制限する）
+IMAGE_PROCESSING_WORKERS = min(4, os.cpu_count() or 1)
+_image_executor = process_resource('image_executor', lambda: ThreadPoolExecutor(
+    max_workers=IMAGE_PROCESSING_WORKERS, thread_name_prefix='image-processing'))
 
-# データベース初期化
-def init_database():
-    """データベースとテーブルを初期化"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
+def process_uploaded_images(uploads):
+    """複数のアップロード画像を並列に検証・処理し、進捗を表示
+
+    uploadsは {表示名: アップロードファイル}（Noneは無視）。全て成功した場合は
+    {表示名: レンディション辞書} を返し、失敗があればエラーを表示してNoneを返す。
+    """
+    uploads = {label: uploaded_file for label, uploaded_file in uploads.items() if uploaded_file is not None}
+    results = {}
+    if not uploads:
+        return results
+    
+    progress = st.progress(0.0, text=f"画像を処理中... 0/{len(uploads)}")
+    futures = {_image_executor.submit(process_image_upload, uploaded_file): label
+               for label, uploaded_file in uploads.items()}
+    errors = []
+    for done, future in enumerate(as_completed(futures), 1):
+        label = futures[future]
+        image_data, message, warnings = future.result()
+        for warning in warnings:
+            st.warning(f"{label}: {warning}")
+        if image_data is None:
+            errors.append(f"{label}: {message}")
+        else:
+            results[label] = image_data
+        progress.progress(done / len(futures), text=f"画像を処理中... {done}/{len(futures)}（{label}）")
+    progress.empty()
     
+    if errors:
+        for error in errors:
+            st.error(error)
+        return None
+    return results
+
+# データベース初期化（各関数はrun_migrations()からマイグレーションとして実行される）
+def create_base_tables(cursor):
+    """基本テーブルを作成"""
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -359,7 +811,7 @@ def init_database():
         )
     ''')
 
-      # セッション保存用テーブル
+    # セッション保存用テーブル
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS user_sessions (
             user_id INTEGER PRIMARY KEY,
@@ -367,7 +819,7 @@ def init_database():
             last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    
+
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS sicks (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -388,7 +840,7 @@ def init_database():
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    
+
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS forms (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -411,34 +863,433 @@ def init_database():
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+
+def create_image_store(cursor):
+    """画像ストアと縮小版のテーブルを作成し、既存の画像を移行"""
+    # 画像ストア（内容のハッシュをIDとして同一画像を1件だけ保存）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS images (
+            id TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            size INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 画像の縮小版（表示幅に応じて使い分ける）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS image_renditions (
+            image_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (image_id, name)
+        )
+    ''')
+
+    # 行内に保存されている旧形式の画像を画像ストアへ移行
+    migrate_inline_images(cursor)
+
+    # Base64のまま保存されている画像をバイナリに変換
+    migrate_image_blobs(cursor)
+
+    # 縮小版のない既存画像に縮小版を生成
+    backfill_image_renditions(cursor)
+
+def create_forms_created_at_index(cursor):
+    """お知らせの新着順表示用のインデックスを作成"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_forms_created_at ON forms (created_at)')
+
+# 管理対象のインデックス（名前: (テーブル, 列)）。一覧の並び順と検索条件に合わせる
+# 追加した場合は、create_managed_indexesを実行するマイグレーションを新しく追加する
+MANAGED_INDEXES = {
+    'idx_sicks_diesease_created_at': ('sicks', 'diesease, created_at'),    # 疾患一覧の並び順、疾患名での検索
+    'idx_forms_created_at': ('forms', 'created_at'),                       # お知らせの新着順
+    'idx_protocols_category_title': ('protocols', 'category, title'),      # カテゴリー別プロトコル一覧
+    'idx_user_sessions_expires_at': ('user_sessions', 'expires_at'),       # 期限切れセッションの削除
+    'idx_sicks_updated_at': ('sicks', 'updated_at'),                       # 差分バックアップ
+    'idx_forms_updated_at': ('forms', 'updated_at'),                       # 差分バックアップ
+    'idx_protocols_updated_at': ('protocols', 'updated_at'),               # 差分バックアップ
+    'idx_images_created_at': ('images', 'created_at'),                     # 差分バックアップ
+    'idx_deleted_rows_deleted_at': ('deleted_rows', 'deleted_at'),         # 差分バックアップ（削除の記録）
+    'idx_users_created_at': ('users', 'created_at'),                       # ユーザー一覧の登録日時順
+    'idx_image_renditions_image_id_width': ('image_renditions', 'image_id, width'),  # 表示幅に合う縮小版の検索
+}
+
+def create_managed_indexes(cursor):
+    """MANAGED_INDEXESのインデックスを作成（まだ存在しないテーブルの分は、そのテーブルを作るマイグレーションで作成）"""
+    tables = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()}
+    for name, (table, columns) in MANAGED_INDEXES.items():
+        if table not in tables:
+            continue
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})')
+
+# 全文検索インデックス（FTS5）
+def _fts5_available():
+    """SQLiteがFTS5に対応しているかチェック"""
+    try:
+        conn = sqlite3.connect(':memory:')
+        conn.execute("CREATE VIRTUAL TABLE fts5_check USING fts5(body)")
+        conn.close()
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+FTS5_AVAILABLE = _fts5_available()
+
+# 検索用n-gramの文字数（2: bigram / 3: trigram）。環境変数 CT_SEARCH_NGRAM で変更
+# 変更すると次回起動時に索引が自動で作り直される
+SEARCH_NGRAM_SIZE = 3 if os.environ.get('CT_SEARCH_NGRAM') == '3' else 2
+
+# 疾患検索の対象カラム
+SICK_SEARCH_COLUMNS = [
+    'diesease', 'diesease_text', 'keyword', 'protocol', 'protocol_text',
+    'processing', 'processing_text', 'contrast', 'contrast_text'
+]
+
+# CTプロトコル検索の対象カラム
+PROTOCOL_SEARCH_COLUMNS = ['title', 'content', 'category']
+
+# BM25の列ごとの重み（未指定の列は1.0）。疾患名・キーワードへの一致を優先する
+SICK_SEARCH_WEIGHTS = {'diesease': 10.0, 'keyword': 5.0, 'protocol': 2.0, 'contrast': 2.0, 'processing': 2.0}
+PROTOCOL_SEARCH_WEIGHTS = {'title': 5.0, 'category': 2.0}
+
+# カタカナ（ァ〜ヶ）をひらがなに対応付ける変換表
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+
+def normalize_search_text(text):
+    """検索用に文字列を正規化（HTMLタグ除去、全角/半角の統一、カタカナ→ひらがな、小文字化）"""
+    if not text:
+        return ""
+    text = html.unescape(re.sub(r'<[^>]+>', ' ', str(text)))
+    text = unicodedata.normalize('NFKC', text).lower()
+    return text.translate(_KATAKANA_TO_HIRAGANA)
+
+def _search_segments(text):
+    """正規化した文字列を記号・空白で区切った文字列のリストに分割"""
+    return [segment for segment in re.split(r'[\W_]+', normalize_search_text(text)) if segment]
+
+def to_search_ngrams(text, n=SEARCH_NGRAM_SIZE):
+    """文字列を空白区切りのn-gramトークン列に変換
+
+    各文字位置から最大n文字を切り出す（末尾はn文字未満のトークンになる）ため、
+    n文字以下の部分文字列は必ずいずれかのトークンの先頭に現れる。
+    """
+    tokens = []
+    for segment in _search_segments(text):
+        tokens.extend(segment[i:i + n] for i in range(len(segment)))
+    return " ".join(tokens)
+
+def register_search_functions(conn):
+    """FTS同期トリガーが使う関数を接続に登録"""
+    conn.create_function('search_ngrams', 2, to_search_ngrams, deterministic=True)
+
+def _fts_schema(table, columns, n=SEARCH_NGRAM_SIZE):
+    """n-gram化したテキストを索引するFTS5テーブルと同期トリガーの定義
+
+    索引のみを持つcontentlessテーブルとし、行の特定はrowid（元テーブルのid）で行う。
+    トリガーはsearch_ngrams()を使うため、書き込みはregister_search_functions()済みの接続で行うこと。
+    """
+    fts = f"{table}_fts"
+    column_list = ", ".join(columns)
+    new_values = ", ".join(f"search_ngrams(new.{col}, {n})" for col in columns)
+    old_values = ", ".join(f"search_ngrams(old.{col}, {n})" for col in columns)
+    source_values = ", ".join(f"search_ngrams({col}, {n})" for col in columns)
+    table_sql = f"CREATE VIRTUAL TABLE {fts} USING fts5({column_list}, content='', tokenize='unicode61 remove_diacritics 0')"
+    triggers = {
+        f'{fts}_ai': f'''CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts}(rowid, {column_list}) VALUES (new.id, {new_values});
+        END''',
+        f'{fts}_ad': f'''CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+        END''',
+        # 画像カラムのみの更新では再索引しない
+        f'{fts}_au': f'''CREATE TRIGGER {fts}_au AFTER UPDATE OF {column_list} ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO {fts}(rowid, {column_list}) VALUES (new.id, {new_values});
+        END''',
+    }
+    populate_sql = f"INSERT INTO {fts}(rowid, {column_list}) SELECT id, {source_values} FROM {table}"
+    return table_sql, triggers, populate_sql
+
+def _ensure_fts_table(cursor, name, table_sql, triggers, populate_sql):
+    """FTSテーブルとトリガーを定義どおりに作成（定義が変わっていれば作り直して再索引）"""
+    cursor.execute("SELECT name, sql FROM sqlite_master WHERE name = ? OR tbl_name = ?", (name, name))
+    existing = {row[0]: row[1] for row in cursor.fetchall()}
+    cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name IN (%s)" % ",".join("?" * len(triggers)),
+                   list(triggers.keys()))
+    existing.update({row[0]: row[1] for row in cursor.fetchall()})
+
+    expected = {name: table_sql, **triggers}
+    if all(existing.get(key) == sql for key, sql in expected.items()):
+        return False
+
+    for trigger_name in triggers:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger_name}")
+    cursor.execute(f"DROP TABLE IF EXISTS {name}")
+    cursor.execute(table_sql)
+    for trigger_sql in triggers.values():
+        cursor.execute(trigger_sql)
+    cursor.execute(populate_sql)
+    return True
+
+def ensure_search_indexes(cursor):
+    """検索用のFTS5インデックスを作成・同期"""
+    if not FTS5_AVAILABLE:
+        return
+    _ensure_fts_table(cursor, 'sicks_fts', *_fts_schema('sicks', SICK_SEARCH_COLUMNS))
+    _ensure_fts_table(cursor, 'protocols_fts', *_fts_schema('protocols', PROTOCOL_SEARCH_COLUMNS))
+
+def bm25_expression(fts_table, columns, weights):
+    """列の重みを指定したbm25()の式を生成（値が小さいほど関連度が高い）"""
+    weight_list = ", ".join(str(float(weights.get(col, 1.0))) for col in columns)
+    return f"bm25({fts_table}, {weight_list})"
+
+def build_fts_query(search_term, n=SEARCH_NGRAM_SIZE):
+    """入力語をn-gram索引用のMATCH式に変換（語ごとに部分一致、全語AND）
+
+    n文字を超える語は連続するn-gramのフレーズ、n文字以下の語は前方一致トークンとして検索する。
+    検索語が空の場合はNoneを返す。
+    """
+    clauses = []
+    for segment in _search_segments(search_term):
+        if len(segment) <= n:
+            clauses.append(f'"{segment}"*')
+        else:
+            grams = [segment[i:i + n] for i in range(len(segment) - n + 1)]
+            clauses.append('"{}"'.format(" ".join(grams)))
+    return " ".join(clauses) or None
+
+# 画像ストア
+# 各コンテンツ行の画像カラムには画像本体ではなく "image:<SHA-256>" 形式の参照を保存する
+# 画像本体はエンコード済みのバイト列をそのままBLOBとして保存する（旧形式のBase64文字列も読み込み可能）
+IMAGE_REF_PREFIX = 'image:'
+
+# 画像を保持するテーブルとカラム
+IMAGE_COLUMNS = {
+    'sicks': ['diesease_img', 'protocol_img', 'processing_img', 'contrast_img'],
+    'forms': ['post_img'],
+    'protocols': ['protocol_img'],
+}
+
+def is_image_ref(value):
+    """画像ストアへの参照かどうか"""
+    return isinstance(value, str) and value.startswith(IMAGE_REF_PREFIX)
+
+def _image_bytes(image_data):
+    """画像データをバイト列に変換（旧形式のBase64文字列はデコード）"""
+    if isinstance(image_data, str):
+        return base64.b64decode(image_data)
+    return bytes(image_data)
+
+def _store_renditions(cursor, image_id, renditions):
+    """縮小版を保存（fullは画像ストア本体のため除く）"""
+    for name, data in renditions.items():
+        if name == 'full':
+            continue
+        width, height = Image.open(BytesIO(data)).size
+        cursor.execute('''
+            INSERT OR IGNORE INTO image_renditions (image_id, name, width, height, data)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (image_id, name, width, height, sqlite3.Binary(data)))
+
+def store_image(cursor, image_value):
+    """画像を画像ストアに保存して参照を返す
+
+    image_valueはvalidate_and_process_image()のレンディション辞書、画像のバイト列、
+    旧形式のBase64文字列のいずれか。参照・空値はそのまま返す。
+    """
+    if not image_value or is_image_ref(image_value):
+        return image_value
+    renditions = image_value if isinstance(image_value, dict) else {'full': image_value}
+    image_bytes = _image_bytes(renditions['full'])
+    image_id = hashlib.sha256(image_bytes).hexdigest()
+    cursor.execute("INSERT OR IGNORE INTO images (id, data, size) VALUES (?, ?, ?)",
+                   (image_id, sqlite3.Binary(image_bytes), len(image_bytes)))
+    _store_renditions(cursor, image_id, renditions)
+    return IMAGE_REF_PREFIX + image_id
+
+# 画像データキャッシュ
+# 画像IDは内容のハッシュなので、同じキーの内容が変わることはなく無効化は不要。
+# 合計バイト数で上限を設け、古いものから追い出す（全セッションで共有）
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('CT_IMAGE_CACHE_MB', '64')) * 1024 * 1024
+_image_cache = process_resource('image_cache', OrderedDict)
+_image_cache_lock = process_resource('image_cache_lock', threading.Lock)
+_image_cache_stats = process_resource('image_cache_stats', lambda: {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0})
+
+def _image_cache_get(key):
+    """キャッシュから画像データを取得（なければNone）"""
+    with _image_cache_lock:
+        data = _image_cache.get(key)
+        if data is None:
+            _image_cache_stats['misses'] += 1
+            return None
+        _image_cache.move_to_end(key)
+        _image_cache_stats['hits'] += 1
+        return data
+
+def _image_cache_put(key, data):
+    """画像データをキャッシュに追加し、上限を超えた分を追い出す"""
+    if len(data) > IMAGE_CACHE_MAX_BYTES:
+        return
+    with _image_cache_lock:
+        if key in _image_cache:
+            return
+        _image_cache[key] = data
+        _image_cache_stats['bytes'] += len(data)
+        while _image_cache_stats['bytes'] > IMAGE_CACHE_MAX_BYTES:
+            _, evicted = _image_cache.popitem(last=False)
+            _image_cache_stats['bytes'] -= len(evicted)
+            _image_cache_stats['evictions'] += 1
+
+def get_image_cache_stats():
+    """画像キャッシュの統計を取得（管理画面表示用）"""
+    with _image_cache_lock:
+        return dict(_image_cache_stats, entries=len(_image_cache), max_bytes=IMAGE_CACHE_MAX_BYTES)
+
+def load_image_data(image_value, width=None):
+    """画像カラムの値から画像のバイト列を取得（旧形式のBase64文字列にも対応）
+
+    widthを指定すると、その幅以上の最小の縮小版を返す（該当なしの場合は本体）。
+    画像ストアの画像は画像キャッシュを経由する。
+    """
+    if not image_value:
+        return None
+    if not is_image_ref(image_value):
+        return _image_bytes(image_value)
     
-    conn.commit()
-    conn.close()
+    cache_key = (image_value, width)
+    data = _image_cache_get(cache_key)
+    if data is None:
+        data = _load_stored_image(image_value[len(IMAGE_REF_PREFIX):], width)
+        if data is not None:
+            _image_cache_put(cache_key, data)
+    return data
+
+IMAGE_SQL = "SELECT data FROM images WHERE id = ?"
+IMAGE_RENDITION_SQL = "SELECT data FROM image_renditions WHERE image_id = ? AND width >= ? ORDER BY width LIMIT 1"
+
+def _load_stored_image(image_id, width):
+    """画像ストアから画像のバイト列を読み込む"""
+    conn = get_db_connection()
+    if width:
+        row = conn.execute(IMAGE_RENDITION_SQL, (image_id, width)).fetchone()
+        if row:
+            return row[0]
+    row = conn.execute(IMAGE_SQL, (image_id,)).fetchone()
+    return _image_bytes(row[0]) if row else None
+
+def purge_unused_images(cursor):
+    """どの行からも参照されなくなった画像を削除"""
+    references = " UNION ALL ".join(
+        f"SELECT {column} FROM {table} WHERE {column} LIKE '{IMAGE_REF_PREFIX}%'"
+        for table, columns in IMAGE_COLUMNS.items() for column in columns
+    )
+    cursor.execute(f"DELETE FROM images WHERE '{IMAGE_REF_PREFIX}' || id NOT IN ({references})")
+    cursor.execute("DELETE FROM image_renditions WHERE image_id NOT IN (SELECT id FROM images)")
+
+def migrate_image_blobs(cursor):
+    """画像ストア内のBase64文字列をバイナリ（BLOB）に置き換える"""
+    cursor.execute("SELECT id FROM images WHERE typeof(data) = 'text'")
+    for (image_id,) in cursor.fetchall():
+        (data,) = cursor.execute("SELECT data FROM images WHERE id = ?", (image_id,)).fetchone()
+        cursor.execute("UPDATE images SET data = ? WHERE id = ?", (sqlite3.Binary(_image_bytes(data)), image_id))
+
+def backfill_image_renditions(cursor):
+    """縮小版のない画像に縮小版を生成"""
+    cursor.execute("SELECT id FROM images WHERE id NOT IN (SELECT DISTINCT image_id FROM image_renditions)")
+    for (image_id,) in cursor.fetchall():
+        (data,) = cursor.execute("SELECT data FROM images WHERE id = ?", (image_id,)).fetchone()
+        try:
+            renditions = create_image_renditions(decode_for_renditions(Image.open(BytesIO(_image_bytes(data)))))
+        except Exception:
+            continue
+        if renditions:
+            _store_renditions(cursor, image_id, renditions)
+
+def migrate_inline_images(cursor):
+    """行内にBase64で保存された画像を画像ストアへ移して参照に置き換える"""
+    for table, columns in IMAGE_COLUMNS.items():
+        condition = " OR ".join(f"({col} != '' AND {col} NOT LIKE '{IMAGE_REF_PREFIX}%')" for col in columns)
+        cursor.execute(f"SELECT id FROM {table} WHERE {condition}")
+        for (row_id,) in cursor.fetchall():
+            row = cursor.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE id = ?", (row_id,)).fetchone()
+            refs = [store_image(cursor, value) for value in row]
+            assignments = ", ".join(f"{col} = ?" for col in columns)
+            cursor.execute(f"UPDATE {table} SET {assignments} WHERE id = ?", (*refs, row_id))
+
+def create_token_sessions(cursor):
+    """user_sessionsをトークンを主キーとする形に作り直す（旧形式のセッションは引き継がない）"""
+    cursor.execute('DROP TABLE IF EXISTS user_sessions')
+    cursor.execute('''
+        CREATE TABLE user_sessions (
+            token TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            session_data TEXT,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_sessions_expires_at ON user_sessions (expires_at)')
+
+# 差分バックアップの対象テーブル（削除をdeleted_rowsに記録する）
+BACKUP_TRACKED_TABLES = ('sicks', 'forms', 'protocols')
+
+def create_backup_tracking(cursor):
+    """差分バックアップ用に削除の記録（トゥームストーン）とバックアップ履歴のテーブルを作成"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS deleted_rows (
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (table_name, row_id)
+        )
+    ''')
+    for table in BACKUP_TRACKED_TABLES:
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_tombstone AFTER DELETE ON {table} BEGIN
+                INSERT OR REPLACE INTO deleted_rows (table_name, row_id, deleted_at) VALUES ('{table}', old.id, CURRENT_TIMESTAMP);
+            END
+        ''')
+    
+    # high_water_markはバックアップ時点の時刻。次の差分バックアップはこれ以降の変更を出力する
+    # 差分バックアップは基準にしたバックアップのbackup_idを持ち、復元時はこれをたどって適用順を決める
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS backup_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            backup_id TEXT NOT NULL,
+            backup_type TEXT NOT NULL,
+            base_backup_id TEXT,
+            since TIMESTAMP,
+            high_water_mark TIMESTAMP NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    create_managed_indexes(cursor)
 
 # 初期データ投入
-def insert_sample_data():
+def insert_sample_data(cursor):
     """サンプルデータを挿入"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
-    
+
     # サンプルユーザーデータ
     sample_users = [
         ("管理者", "admin@hospital.jp", "Okiyoshi1126"),
         ("技師", "tech@hospital.jp", "Tech123")
     ]
-    
+
     for user_data in sample_users:
         cursor.execute("SELECT COUNT(*) FROM users WHERE email = ?", (user_data[1],))
         if cursor.fetchone()[0] == 0:
             cursor.execute("INSERT INTO users (name, email, password) VALUES (?, ?, ?)",
                           (user_data[0], user_data[1], hash_password(user_data[2])))
-    
+
     # 疾患サンプルデータ（修正版）
     sample_sicks = [
         ("脳梗塞", "脳血管が詰まる疾患", "脳梗塞,stroke", "頭部造影CT", "造影剤使用", "緊急検査", "迅速な対応", "あり", "造影剤注入", "", "", "", ""),
         ("肺炎", "肺の感染症", "肺炎,pneumonia", "胸部CT", "単純CT", "標準撮影", "呼吸停止", "なし", "造影不要", "", "", "", "")
     ]
-    
+
     for sick in sample_sicks:
         cursor.execute("SELECT COUNT(*) FROM sicks WHERE diesease = ?", (sick[0],))
         if cursor.fetchone()[0] == 0:
@@ -450,356 +1301,615 @@ def insert_sample_data():
                     diesease_img, protocol_img, processing_img, contrast_img
                 ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', sick)
-    
+
     # お知らせサンプルデータ
     sample_forms = [
         ("システム運用開始", "CT医療システムの運用を開始しました。", ""),
         ("利用方法について", "疾患検索機能をご活用ください。", "")
     ]
-    
+
     for form in sample_forms:
         cursor.execute("SELECT COUNT(*) FROM forms WHERE title = ?", (form[0],))
         if cursor.fetchone()[0] == 0:
             cursor.execute("INSERT INTO forms (title, main, post_img) VALUES (?, ?, ?)", form)
-    
+
     # CTプロトコルサンプルデータ
     sample_protocols = [
         ("頭部", "頭部単純CT", "スライス厚: 5mm\n電圧: 120kV\n電流: 250mA", ""),
         ("胸部", "胸部造影CT", "スライス厚: 1mm\n電圧: 120kV\n造影剤: 100ml", "")
     ]
-    
+
     for protocol in sample_protocols:
         cursor.execute("SELECT COUNT(*) FROM protocols WHERE title = ? AND category = ?", (protocol[1], protocol[0]))
         if cursor.fetchone()[0] == 0:
             cursor.execute("INSERT INTO protocols (category, title, content, protocol_img) VALUES (?, ?, ?, ?)", protocol)
-    
-    conn.commit()
-    conn.close()
+
+# スキーママイグレーション
+# 適用済みのバージョンをPRAGMA user_versionに記録し、未適用のものだけを順に実行する。
+# テーブル・カラム・インデックスの追加は末尾に新しいバージョンを追加して行う（適用済みのものは変更しない）
+MIGRATIONS = [
+    (1, "基本テーブルの作成", create_base_tables),
+    (2, "画像ストアの作成と既存画像の移行", create_image_store),
+    (3, "お知らせの作成日時インデックス", create_forms_created_at_index),
+    (4, "サンプルデータの投入", insert_sample_data),
+    (5, "セッションをトークン単位に変更", create_token_sessions),
+    (6, "一覧・検索用インデックスの作成", create_managed_indexes),
+    (7, "差分バックアップ用の変更記録", create_backup_tracking),
+    (8, "ユーザー一覧・画像縮小版用インデックスの作成", create_managed_indexes),
+]
+
+_migration_state = process_resource('migration_state', lambda: {'checked': False})
+_migrations_lock = process_resource('migrations_lock', threading.Lock)
+
+def get_migration_description(version):
+    """マイグレーションの説明を取得（管理画面表示用。該当なしは空文字）"""
+    return next((description for number, description, _ in MIGRATIONS if number == version), "")
+
+def get_schema_version():
+    """データベースに適用済みのスキーマバージョンを取得"""
+    return get_db_connection().execute("PRAGMA user_version").fetchone()[0]
+
+def run_migrations():
+    """未適用のマイグレーションを実行（プロセスごとに一度だけ確認し、以降の再実行では何もしない）"""
+    if _migration_state['checked']:
+        return
+    with _migrations_lock:
+        if _migration_state['checked']:
+            return
+        
+        apply_storage_profile()
+        for version, _, migrate in MIGRATIONS:
+            if version <= get_schema_version():
+                continue
+            with db_transaction() as cursor:
+                # 書き込みロックを取ってから再確認する（複数プロセスが同時に起動した場合）
+                cursor.execute("BEGIN IMMEDIATE")
+                if version <= get_schema_version():
+                    continue
+                migrate(cursor)
+                cursor.execute(f"PRAGMA user_version = {int(version)}")
+        
+        # 全文検索インデックスは設定（n-gramの文字数）に応じて作り直すため、起動ごとに確認する
+        with db_transaction() as cursor:
+            ensure_search_indexes(cursor)
+        
+        _migration_state['checked'] = True
 
 # 認証機能
 def hash_password(password):
     """パスワードをハッシュ化"""
     return hashlib.sha256(password.encode()).hexdigest()
 
+AUTHENTICATE_SQL = "SELECT id, name, email FROM users WHERE email = ? AND password = ?"
+
 def authenticate_user(email, password):
     """ユーザー認証"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, name, email FROM users WHERE email = ? AND password = ?", 
-                   (email, hash_password(password)))
-    user = cursor.fetchone()
-    conn.close()
-    return user
+    conn = get_db_connection()
+    return conn.execute(AUTHENTICATE_SQL, (email, hash_password(password))).fetchone()
 
 def register_user(name, email, password):
     """新規ユーザー登録"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
     try:
-        cursor.execute("INSERT INTO users (name, email, password) VALUES (?, ?, ?)",
-                      (name, email, hash_password(password)))
-        conn.commit()
-        conn.close()
+        with db_transaction() as cursor:
+            cursor.execute("INSERT INTO users (name, email, password) VALUES (?, ?, ?)",
+                          (name, email, hash_password(password)))
         return True
     except sqlite3.IntegrityError:
-        conn.close()
         return False
 
-# データベース操作関数
-def get_all_sicks():
-    """全疾患データを取得"""
-    conn = sqlite3.connect('medical_ct.db')
-    df = pd.read_sql_query("SELECT * FROM sicks ORDER BY diesease", conn)
-    conn.close()
-    return df
-
-def search_sicks(search_term):
-    """疾患データを検索"""
-    conn = sqlite3.connect('medical_ct.db')
-    query = """
-        SELECT * FROM sicks 
-        WHERE diesease LIKE ? OR diesease_text LIKE ? OR keyword LIKE ? 
+# 一覧表示用の列（画像カラムは読み込まない）
+# previewは本文の先頭部分。LIST_PREVIEW_LENGTHより1文字多く取得し、省略記号の要否を判定できるようにする
+LIST_PREVIEW_LENGTH = 200
+SICK_SUMMARY_COLUMNS = f"sicks.id, sicks.diesease, sicks.keyword, sicks.protocol, substr(sicks.diesease_text, 1, {LIST_PREVIEW_LENGTH + 1}) AS preview"
+FORM_SUMMARY_COLUMNS = f"forms.id, forms.title, substr(forms.main, 1, {LIST_PREVIEW_LENGTH + 1}) AS preview, forms.created_at"
+PROTOCOL_SUMMARY_COLUMNS = f"protocols.id, protocols.category, protocols.title, substr(protocols.content, 1, {LIST_PREVIEW_LENGTH + 1}) AS preview, protocols.created_at, protocols.updated_at"
+
+# 詳細表示用の列（画像列は画像の有無のフラグに置き換え、列の位置はsicksテーブルと同じ）
+SICK_DETAIL_COLUMNS = ", ".join(
+    ["id", "diesease", "diesease_text", "keyword", "protocol", "protocol_text",
+     "processing", "processing_text", "contrast", "contrast_text"]
+    + [f"COALESCE({column}, '') != '' AS has_{column}" for column in IMAGE_COLUMNS['sicks']]
+    + ["created_at", "updated_at"]
+)
+
+# 各データ関数のSQL。インデックス確認（get_query_plan_checks）も同じ定数を使う
+SICK_LIST_SQL = f"SELECT {SICK_SUMMARY_COLUMNS} FROM sicks ORDER BY diesease LIMIT ? OFFSET ?"
+SICK_SEARCH_SQL = f"""
+    SELECT {SICK_SUMMARY_COLUMNS} FROM sicks_fts
+    JOIN sicks ON sicks.id = sicks_fts.rowid
+    WHERE sicks_fts MATCH ?
+    ORDER BY {bm25_expression('sicks_fts', SICK_SEARCH_COLUMNS, SICK_SEARCH_WEIGHTS)}, sicks.diesease
+    LIMIT ? OFFSET ?
+"""
+SICK_SEARCH_COUNT_SQL = "SELECT COUNT(*) FROM sicks_fts WHERE sicks_fts MATCH ?"
+SICK_LIKE_CONDITION = """
+        diesease LIKE ? OR diesease_text LIKE ? OR keyword LIKE ? 
         OR protocol LIKE ? OR protocol_text LIKE ? OR processing LIKE ? 
         OR processing_text LIKE ? OR contrast LIKE ? OR contrast_text LIKE ?
-        ORDER BY diesease
+"""
+SICK_LIKE_SEARCH_SQL = f"""
+    SELECT {SICK_SUMMARY_COLUMNS} FROM sicks 
+    WHERE {SICK_LIKE_CONDITION}
+    ORDER BY diesease
+    LIMIT ? OFFSET ?
+"""
+SICK_LIKE_COUNT_SQL = f"SELECT COUNT(*) FROM sicks WHERE {SICK_LIKE_CONDITION}"
+SICK_DETAIL_SQL = f"SELECT {SICK_DETAIL_COLUMNS} FROM sicks WHERE id = ?"
+FORM_LIST_SQL = f"SELECT {FORM_SUMMARY_COLUMNS} FROM forms ORDER BY created_at DESC LIMIT ? OFFSET ?"
+LATEST_FORMS_SQL = f"SELECT {FORM_SUMMARY_COLUMNS} FROM forms ORDER BY created_at DESC LIMIT ?"
+FORM_BY_ID_SQL = "SELECT * FROM forms WHERE id = ?"
+PROTOCOL_LIST_SQL = f"SELECT {PROTOCOL_SUMMARY_COLUMNS} FROM protocols ORDER BY category, title"
+PROTOCOL_SEARCH_SQL = f"""
+    SELECT {PROTOCOL_SUMMARY_COLUMNS} FROM protocols_fts
+    JOIN protocols ON protocols.id = protocols_fts.rowid
+    WHERE protocols_fts MATCH ?
+    ORDER BY {bm25_expression('protocols_fts', PROTOCOL_SEARCH_COLUMNS, PROTOCOL_SEARCH_WEIGHTS)}, protocols.category, protocols.title
+"""
+PROTOCOL_LIKE_SEARCH_SQL = f"""
+    SELECT {PROTOCOL_SUMMARY_COLUMNS} FROM protocols 
+    WHERE title LIKE ? OR content LIKE ? OR category LIKE ?
+    ORDER BY category, title
+"""
+PROTOCOL_BY_ID_SQL = "SELECT * FROM protocols WHERE id = ?"
+
+def preview_text(text, length):
+    """一覧表示用に本文を指定文字数で省略"""
+    text = text or ""
+    return text[:length] + "..." if len(text) > length else text
+
+# データベース操作関数
+@cached_query
+def get_sick_list(limit=None, offset=0):
+    """疾患一覧を取得（一覧表示用の列のみ。limit/offsetを指定するとその範囲のみ取得）"""
+    return pd.read_sql_query(SICK_LIST_SQL, get_db_connection(), params=[limit if limit is not None else -1, offset])
+
+@cached_query
+def count_sicks():
+    """疾患データの件数を取得"""
+    return get_db_connection().execute("SELECT COUNT(*) FROM sicks").fetchone()[0]
+
+@cached_query
+def search_sicks(search_term, limit=None, offset=0):
+    """疾患データを検索（FTS5インデックスを使用、関連度順）
+
+    結果は一覧表示用の列のみ。limit/offsetを指定するとその範囲のみ取得する。
+    総件数はcount_search_sicks()で取得。
     """
+    fts_query = build_fts_query(search_term) if FTS5_AVAILABLE else None
+    if not fts_query:
+        return _search_sicks_like(search_term, limit, offset)
+    
+    params = [fts_query, limit if limit is not None else -1, offset]
+    return pd.read_sql_query(SICK_SEARCH_SQL, get_db_connection(), params=params)
+
+@cached_query
+def count_search_sicks(search_term):
+    """疾患データの検索結果件数を取得"""
+    fts_query = build_fts_query(search_term) if FTS5_AVAILABLE else None
+    conn = get_db_connection()
+    if not fts_query:
+        search_pattern = f"%{search_term}%"
+        return conn.execute(SICK_LIKE_COUNT_SQL, [search_pattern] * 9).fetchone()[0]
+    return conn.execute(SICK_SEARCH_COUNT_SQL, (fts_query,)).fetchone()[0]
+
+def _search_sicks_like(search_term, limit=None, offset=0):
+    """疾患データを検索（FTS5非対応環境向けのLIKE検索）"""
     search_pattern = f"%{search_term}%"
-    params = [search_pattern] * 9
-    df = pd.read_sql_query(query, conn, params=params)
-    conn.close()
-    return df
+    params = [search_pattern] * 9 + [limit if limit is not None else -1, offset]
+    return pd.read_sql_query(SICK_LIKE_SEARCH_SQL, get_db_connection(), params=params)
 
 def get_sick_by_id(sick_id):
     """IDで疾患データを取得"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM sicks WHERE id = ?", (sick_id,))
-    sick = cursor.fetchone()
-    conn.close()
-    return sick
+    return get_db_connection().execute("SELECT * FROM sicks WHERE id = ?", (sick_id,)).fetchone()
 
-def get_all_forms():
-    """全お知らせを取得"""
-    conn = sqlite3.connect('medical_ct.db')
-    df = pd.read_sql_query("SELECT * FROM forms ORDER BY created_at DESC", conn)
-    conn.close()
-    return df
+def get_sick_detail(sick_id):
+    """IDで疾患データを取得（画像は読み込まず、画像列には有無のフラグを返す）"""
+    return get_db_connection().execute(SICK_DETAIL_SQL, (sick_id,)).fetchone()
+
+def get_sick_image(sick_id, column):
+    """疾患データの画像列を1つだけ取得"""
+    if column not in IMAGE_COLUMNS['sicks']:
+        raise ValueError(f"画像列ではありません: {column}")
+    row = get_db_connection().execute(f"SELECT {column} FROM sicks WHERE id = ?", (sick_id,)).fetchone()
+    return row[0] if row else None
+
+@cached_query
+def get_form_list(limit=None, offset=0):
+    """お知らせ一覧を取得（一覧表示用の列のみ。limit/offsetを指定するとその範囲のみ取得）"""
+    return pd.read_sql_query(FORM_LIST_SQL, get_db_connection(), params=[limit if limit is not None else -1, offset])
+
+@cached_query
+def get_latest_forms(limit):
+    """最新のお知らせを指定件数だけ取得（一覧表示用の列のみ。forms(created_at)のインデックスを使用）"""
+    return pd.read_sql_query(LATEST_FORMS_SQL, get_db_connection(), params=[limit])
+
+@cached_query
+def count_forms():
+    """お知らせの件数を取得"""
+    return get_db_connection().execute("SELECT COUNT(*) FROM forms").fetchone()[0]
 
 def get_form_by_id(form_id):
     """IDでお知らせを取得"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM forms WHERE id = ?", (form_id,))
-    form = cursor.fetchone()
-    conn.close()
-    return form
+    return get_db_connection().execute(FORM_BY_ID_SQL, (form_id,)).fetchone()
 
 def add_sick(diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text, diesease_img=None, protocol_img=None, processing_img=None, contrast_img=None):
-    """新しい疾患データを追加"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO sicks (diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text, diesease_img, protocol_img, processing_img, contrast_img)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text, diesease_img, protocol_img, processing_img, contrast_img))
-    conn.commit()
-    conn.close()
+    """新しい疾患データを追加（追加した行のIDを返す）"""
+    with db_transaction() as cursor:
+        diesease_img, protocol_img, processing_img, contrast_img = (
+            store_image(cursor, img) for img in (diesease_img, protocol_img, processing_img, contrast_img))
+        cursor.execute('''
+            INSERT INTO sicks (diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text, diesease_img, protocol_img, processing_img, contrast_img)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text, diesease_img, protocol_img, processing_img, contrast_img))
+        return cursor.lastrowid
 
 def add_form(title, main, post_img=None):
     """新しいお知らせを追加"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO forms (title, main, post_img) VALUES (?, ?, ?)', (title, main, post_img))
-    conn.commit()
-    conn.close()
+    with db_transaction() as cursor:
+        post_img = store_image(cursor, post_img)
+        cursor.execute('INSERT INTO forms (title, main, post_img) VALUES (?, ?, ?)', (title, main, post_img))
 
 def update_sick(sick_id, diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text, diesease_img=None, protocol_img=None, processing_img=None, contrast_img=None):
     """疾患データを更新"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE sicks SET diesease=?, diesease_text=?, keyword=?, protocol=?, protocol_text=?, 
-        processing=?, processing_text=?, contrast=?, contrast_text=?, diesease_img=?, protocol_img=?, processing_img=?, contrast_img=?, updated_at=CURRENT_TIMESTAMP
-        WHERE id=?
-    ''', (diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text, diesease_img, protocol_img, processing_img, contrast_img, sick_id))
-    conn.commit()
-    conn.close()
+    with db_transaction() as cursor:
+        diesease_img, protocol_img, processing_img, contrast_img = (
+            store_image(cursor, img) for img in (diesease_img, protocol_img, processing_img, contrast_img))
+        cursor.execute('''
+            UPDATE sicks SET diesease=?, diesease_text=?, keyword=?, protocol=?, protocol_text=?, 
+            processing=?, processing_text=?, contrast=?, contrast_text=?, diesease_img=?, protocol_img=?, processing_img=?, contrast_img=?, updated_at=CURRENT_TIMESTAMP
+            WHERE id=?
+        ''', (diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text, diesease_img, protocol_img, processing_img, contrast_img, sick_id))
+        purge_unused_images(cursor)
 
 def update_form(form_id, title, main, post_img=None):
     """お知らせを更新"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE forms SET title=?, main=?, post_img=?, updated_at=CURRENT_TIMESTAMP WHERE id=?', (title, main, post_img, form_id))
-    conn.commit()
-    conn.close()
+    with db_transaction() as cursor:
+        post_img = store_image(cursor, post_img)
+        cursor.execute('UPDATE forms SET title=?, main=?, post_img=?, updated_at=CURRENT_TIMESTAMP WHERE id=?', (title, main, post_img, form_id))
+        purge_unused_images(cursor)
 
 def delete_form(form_id):
     """お知らせを削除"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM forms WHERE id = ?', (form_id,))
-    conn.commit()
-    conn.close()
+    with db_transaction() as cursor:
+        cursor.execute('DELETE FROM forms WHERE id = ?', (form_id,))
+        purge_unused_images(cursor)
 
 def delete_sick(sick_id):
     """疾患データを削除"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM sicks WHERE id = ?', (sick_id,))
-    conn.commit()
-    conn.close()
+    with db_transaction() as cursor:
+        cursor.execute('DELETE FROM sicks WHERE id = ?', (sick_id,))
+        purge_unused_images(cursor)
 
-def get_all_protocols():
-    """全CTプロトコルを取得"""
-    conn = sqlite3.connect('medical_ct.db')
-    df = pd.read_sql_query("SELECT * FROM protocols ORDER BY category, title", conn)
-    conn.close()
-    return df
+@cached_query
+def get_protocol_lists_by_category():
+    """全カテゴリーのCTプロトコル一覧を1回のクエリで取得（一覧表示用の列のみ）
 
-def get_protocols_by_category(category):
-    """カテゴリー別CTプロトコルを取得"""
-    conn = sqlite3.connect('medical_ct.db')
-    df = pd.read_sql_query("SELECT * FROM protocols WHERE category = ? ORDER BY title", conn, params=[category])
-    conn.close()
-    return df
+    {カテゴリー: DataFrame} を返す。プロトコルのないカテゴリーは含まれない。
+    """
+    df = pd.read_sql_query(PROTOCOL_LIST_SQL, get_db_connection())
+    return {category: group.reset_index(drop=True) for category, group in df.groupby('category', sort=False)}
 
+@cached_query
 def search_protocols(search_term):
-    """CTプロトコルを検索"""
-    conn = sqlite3.connect('medical_ct.db')
-    query = """
-        SELECT * FROM protocols 
-        WHERE title LIKE ? OR content LIKE ? OR category LIKE ?
-        ORDER BY category, title
-    """
+    """CTプロトコルを検索（FTS5インデックスを使用、関連度順。結果は一覧表示用の列のみ）"""
+    fts_query = build_fts_query(search_term) if FTS5_AVAILABLE else None
+    if not fts_query:
+        return _search_protocols_like(search_term)
+    return pd.read_sql_query(PROTOCOL_SEARCH_SQL, get_db_connection(), params=[fts_query])
+
+def _search_protocols_like(search_term):
+    """CTプロトコルを検索（FTS5非対応環境向けのLIKE検索）"""
     search_pattern = f"%{search_term}%"
     params = [search_pattern] * 3
-    df = pd.read_sql_query(query, conn, params=params)
-    conn.close()
-    return df
+    return pd.read_sql_query(PROTOCOL_LIKE_SEARCH_SQL, get_db_connection(), params=params)
 
 def get_protocol_by_id(protocol_id):
     """IDでCTプロトコルを取得"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM protocols WHERE id = ?", (protocol_id,))
-    protocol = cursor.fetchone()
-    conn.close()
-    return protocol
+    return get_db_connection().execute(PROTOCOL_BY_ID_SQL, (protocol_id,)).fetchone()
 
 def add_protocol(category, title, content, protocol_img=None):
-    """新しいCTプロトコルを追加"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO protocols (category, title, content, protocol_img)
-        VALUES (?, ?, ?, ?)
-    ''', (category, title, content, protocol_img))
-    conn.commit()
-    conn.close()
+    """新しいCTプロトコルを追加（追加した行のIDを返す）"""
+    with db_transaction() as cursor:
+        protocol_img = store_image(cursor, protocol_img)
+        cursor.execute('''
+            INSERT INTO protocols (category, title, content, protocol_img)
+            VALUES (?, ?, ?, ?)
+        ''', (category, title, content, protocol_img))
+        return cursor.lastrowid
 
 def update_protocol(protocol_id, category, title, content, protocol_img=None):
     """CTプロトコルを更新"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE protocols SET category=?, title=?, content=?, protocol_img=?, updated_at=CURRENT_TIMESTAMP
-        WHERE id=?
-    ''', (category, title, content, protocol_img, protocol_id))
-    conn.commit()
-    conn.close()
+    with db_transaction() as cursor:
+        protocol_img = store_image(cursor, protocol_img)
+        cursor.execute('''
+            UPDATE protocols SET category=?, title=?, content=?, protocol_img=?, updated_at=CURRENT_TIMESTAMP
+            WHERE id=?
+        ''', (category, title, content, protocol_img, protocol_id))
+        purge_unused_images(cursor)
 
 def delete_protocol(protocol_id):
     """CTプロトコルを削除"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM protocols WHERE id = ?', (protocol_id,))
-    conn.commit()
-    conn.close()
+    with db_transaction() as cursor:
+        cursor.execute('DELETE FROM protocols WHERE id = ?', (protocol_id,))
+        purge_unused_images(cursor)
 
-def export_all_data():
-    """全データをJSONでエクスポート"""
-    conn = sqlite3.connect('medical_ct.db')
-    
-    # 全テーブルのデータを取得
-    data = {
-        'export_info': {
-            'export_date': datetime.now().isoformat(),
-            'version': '1.0',
-            'app_name': 'How to CT Medical System'
-        },
-        'users': [],
-        'sicks': [],
-        'forms': [],
-        'protocols': []
-    }
-    
+# 実行計画の確認で想定内とする項目（データ関数の性質上避けられないもの）
+PLAN_FULL_SCAN = 'full_scan'    # 全件走査（前方一致でないLIKE検索や、全件を返す一覧など）
+PLAN_TEMP_SORT = 'temp_sort'    # 一時B-treeでの並べ替え（検索結果の関連度順など、インデックスで並べられないもの）
+
+def get_query_plan_checks():
+    """インデックス確認の対象クエリを取得
+
+    (名前, SQL, パラメータ, 想定内の項目) のリストを返す。SQLは各データ関数と同じ定数を使い、
+    パラメータはダミー値。全文検索のクエリはFTS5が使える場合のみ含める。
+    """
+    checks = [
+        ("疾患一覧 (get_sick_list)", SICK_LIST_SQL, (LIST_PAGE_SIZE, 0), ()),
+        ("疾患検索・LIKE (search_sicks)", SICK_LIKE_SEARCH_SQL, ("",) * 9 + (LIST_PAGE_SIZE, 0), (PLAN_FULL_SCAN,)),
+        ("疾患検索件数・LIKE (count_search_sicks)", SICK_LIKE_COUNT_SQL, ("",) * 9, (PLAN_FULL_SCAN,)),
+        ("疾患詳細 (get_sick_detail)", SICK_DETAIL_SQL, (0,), ()),
+        ("お知らせ一覧 (get_form_list)", FORM_LIST_SQL, (LIST_PAGE_SIZE, 0), ()),
+        ("最新のお知らせ (get_latest_forms)", LATEST_FORMS_SQL, (HOME_NOTICE_COUNT,), ()),
+        ("お知らせ詳細 (get_form_by_id)", FORM_BY_ID_SQL, (0,), ()),
+        ("プロトコル一覧 (get_protocol_lists_by_category)", PROTOCOL_LIST_SQL, (), (PLAN_FULL_SCAN,)),
+        ("プロトコル検索・LIKE (search_protocols)", PROTOCOL_LIKE_SEARCH_SQL, ("",) * 3, (PLAN_FULL_SCAN,)),
+        ("プロトコル詳細 (get_protocol_by_id)", PROTOCOL_BY_ID_SQL, (0,), ()),
+        ("ログイン (authenticate_user)", AUTHENTICATE_SQL, ("", ""), ()),
+        ("ユーザー (get_user_by_id)", USER_BY_ID_SQL, (0,), ()),
+        ("ユーザー一覧 (get_all_users)", USER_LIST_SQL, (), (PLAN_FULL_SCAN,)),
+        ("セッション復元 (load_session_from_db)", SESSION_LOAD_SQL, ("", ""), ()),
+        ("期限切れセッション削除 (purge_expired_sessions)", SESSION_PURGE_SQL, ("",), ()),
+        ("画像 (load_image_data)", IMAGE_SQL, ("",), ()),
+        ("画像の縮小版 (load_image_data)", IMAGE_RENDITION_SQL, ("", 0), ()),
+    ]
+    if FTS5_AVAILABLE:
+        checks += [
+            ("疾患検索 (search_sicks)", SICK_SEARCH_SQL, ("", LIST_PAGE_SIZE, 0), (PLAN_TEMP_SORT,)),
+            ("疾患検索件数 (count_search_sicks)", SICK_SEARCH_COUNT_SQL, ("",), ()),
+            ("プロトコル検索 (search_protocols)", PROTOCOL_SEARCH_SQL, ("",), (PLAN_TEMP_SORT,)),
+        ]
+    return checks + [
+        (f"差分バックアップ: {key} (write_export_json)", f"{query} WHERE {change_column} >= ?", ("",), ())
+        for key, query, change_column in EXPORT_QUERIES + [DELETED_ROWS_QUERY] if key != 'users'
+    ]
+
+def verify_query_plans():
+    """EXPLAIN QUERY PLANで各クエリがインデックスを使うか確認
+
+    各クエリについて {'query', 'uses_index', 'temp_sort', 'expected', 'ok', 'plan'} を返す。
+    "SCAN テーブル"の行は、インデックス経由（USING INDEX）でも全行を読むため全件走査とみなす。
+    例外は、WHERE句がなくインデックスの順にLIMIT件だけ読むページング（一時B-treeでの並べ替えなし）と、
+    全文検索インデックス（VIRTUAL TABLE INDEX）の検索。全件走査があればuses_indexはFalse、
+    一時B-treeでの並べ替え（"USE TEMP B-TREE"）があればtemp_sortはTrueになる。
+    どちらかがあり、それが想定内の項目（expected）でなければokはFalseになる。
+    """
+    conn = get_db_connection()
+    results = []
+    for name, sql, params, expected in get_query_plan_checks():
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+        temp_sort = any(detail.startswith('USE TEMP B-TREE') for detail in plan)
+        limit_bounded = (re.search(r'\bLIMIT\b', sql) and not re.search(r'\bWHERE\b', sql)
+                         and not temp_sort)
+        full_scan = any(
+            detail.startswith('SCAN ') and ' VIRTUAL TABLE INDEX ' not in detail
+            and not (limit_bounded and ' USING ' in detail)
+            for detail in plan
+        )
+        ok = (not full_scan or PLAN_FULL_SCAN in expected) and (not temp_sort or PLAN_TEMP_SORT in expected)
+        results.append({'query': name, 'uses_index': not full_scan, 'temp_sort': temp_sort,
+                        'expected': expected, 'ok': ok, 'plan': " / ".join(plan)})
+    return results
+
+# エクスポート対象（JSONのキー, SQL, 変更日時の列）。ユーザーのパスワードは含めない
+# 画像は各データの画像欄（"image:<id>"）から参照され、imagesにBase64で1件ずつ出力する
+# 差分バックアップでは、変更日時の列が前回のバックアップ時点以降の行だけを出力する
+EXPORT_QUERIES = [
+    ('users', "SELECT id, name, email, created_at, updated_at FROM users", 'updated_at'),
+    ('sicks', "SELECT * FROM sicks", 'updated_at'),
+    ('forms', "SELECT * FROM forms", 'updated_at'),
+    ('protocols', "SELECT * FROM protocols", 'updated_at'),
+    ('images', "SELECT id, data, created_at FROM images", 'created_at'),
+]
+# 差分バックアップのみに含める削除の記録
+DELETED_ROWS_QUERY = ('deleted_rows', "SELECT table_name, row_id, deleted_at FROM deleted_rows", 'deleted_at')
+
+# 差分バックアップの開始時刻を前回のバックアップ時点から戻す秒数。
+# updated_atはコミット時ではなく書き込み時の時刻のため、バックアップ時点をまたいだ変更を取りこぼさないようにする
+# （重ねて出力された行は復元時に同じ内容で上書きされるだけ）
+BACKUP_OVERLAP_SECONDS = 60
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'  # CURRENT_TIMESTAMPの形式（UTC）
+
+def _backup_cutoff(since):
+    """差分バックアップで出力する変更日時の下限"""
+    return (datetime.strptime(since, TIMESTAMP_FORMAT) - timedelta(seconds=BACKUP_OVERLAP_SECONDS)).strftime(TIMESTAMP_FORMAT)
+
+def _begin_read_snapshot(conn):
+    """読み取りトランザクションを開始して読む時点を固定し、その時刻（CURRENT_TIMESTAMP）を返す"""
+    conn.execute("BEGIN")
+    conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    return conn.execute("SELECT CURRENT_TIMESTAMP").fetchone()[0]
+
+def _export_record(key, columns, row):
+    """エクスポート用に1行を辞書に変換"""
+    record = dict(zip(columns, row))
+    for column in ('created_at', 'updated_at'):
+        if column in record and not record[column]:
+            record[column] = ''
+    if key == 'images':
+        record['data'] = base64.b64encode(_image_bytes(record['data'])).decode()
+    return record
+
+def write_export_json(output, conn=None, since=None, high_water_mark=None, extra_info=None):
+    """全データをJSONで書き出し、バックアップ時点（high_water_mark）を返す（バックアップJSON version 1.2）
+
+    outputはテキストのファイルオブジェクト。カーソルから1行ずつ書き込むため、
+    データベースの大きさによらずメモリ使用量は一定。全テーブルを同じ時点の内容で読む。
+    connを指定するとその接続（スナップショットなど）から読む。スナップショットの場合は
+    作成した時点をhigh_water_markに指定する。
+    sinceを指定すると差分バックアップとして、その時点以降に追加・更新された行と削除の記録だけを書き出す。
+    extra_infoはexport_infoに追加する項目（バックアップIDなど）。
+    """
+    conn = conn or get_db_connection()
     try:
-        # ユーザーデータ（パスワードは除外）
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, email, created_at, updated_at FROM users")
-        users = cursor.fetchall()
-        for user in users:
-            data['users'].append({
-                'id': user[0],
-                'name': user[1],
-                'email': user[2],
-                'created_at': user[3] if user[3] else '',
-                'updated_at': user[4] if user[4] else ''
-            })
-        
-        # 疾患データ
-        cursor.execute("SELECT * FROM sicks")
-        sicks = cursor.fetchall()
-        for sick in sicks:
-            data['sicks'].append({
-                'id': sick[0],
-                'diesease': sick[1],
-                'diesease_text': sick[2],
-                'keyword': sick[3],
-                'protocol': sick[4],
-                'protocol_text': sick[5],
-                'processing': sick[6],
-                'processing_text': sick[7],
-                'contrast': sick[8],
-                'contrast_text': sick[9],
-                'diesease_img': sick[10],
-                'protocol_img': sick[11],
-                'processing_img': sick[12],
-                'contrast_img': sick[13],
-                'created_at': sick[14] if sick[14] else '',
-                'updated_at': sick[15] if sick[15] else ''
-            })
-        
-        # お知らせデータ
-        cursor.execute("SELECT * FROM forms")
-        forms = cursor.fetchall()
-        for form in forms:
-            data['forms'].append({
-                'id': form[0],
-                'title': form[1],
-                'main': form[2],
-                'post_img': form[3],
-                'created_at': form[4] if form[4] else '',
-                'updated_at': form[5] if form[5] else ''
-            })
-        
-        # CTプロトコルデータ
-        cursor.execute("SELECT * FROM protocols")
-        protocols = cursor.fetchall()
-        for protocol in protocols:
-            data['protocols'].append({
-                'id': protocol[0],
-                'category': protocol[1],
-                'title': protocol[2],
-                'content': protocol[3],
-                'protocol_img': protocol[4],
-                'created_at': protocol[5] if protocol[5] else '',
-                'updated_at': protocol[6] if protocol[6] else ''
-            })
+        taken_at = _begin_read_snapshot(conn)
+        high_water_mark = high_water_mark or taken_at
         
-    except Exception as e:
-        conn.close()
-        return None, f"データエクスポート中にエラーが発生しました: {str(e)}"
+        export_info = {
+            'export_date': datetime.now().isoformat(),
+            'version': '1.2',
+            'app_name': 'How to CT Medical System',
+            'backup_type': 'full' if since is None else 'incremental',
+            'high_water_mark': high_water_mark,
+            **(extra_info or {}),
+        }
+        queries = EXPORT_QUERIES
+        if since is not None:
+            export_info['since'] = since
+            queries = EXPORT_QUERIES + [DELETED_ROWS_QUERY]
+        output.write('{\n  "export_info": ' + json.dumps(export_info, ensure_ascii=False))
+        
+        for key, query, change_column in queries:
+            params = ()
+            if since is not None:
+                query = f"{query} WHERE {change_column} >= ?"
+                params = (_backup_cutoff(since),)
+            output.write(f',\n  "{key}": [')
+            cursor = conn.execute(query, params)
+            columns = [description[0] for description in cursor.description]
+            separator = '\n    '
+            for row in cursor:
+                output.write(separator + json.dumps(_export_record(key, columns, row), ensure_ascii=False))
+                separator = ',\n    '
+            output.write('\n  ]')
+    finally:
+        conn.rollback()
     
-    conn.close()
-    return data, "OK"
+    output.write('\n}\n')
+    return high_water_mark
+
+# バックアップ
+BACKUP_PAGES_PER_STEP = 1024  # オンラインバックアップで1回にコピーするページ数（4KBページで約4MB）
+BACKUP_STEP_PAUSE = 0.01      # ステップ間の待機（秒）。他のセッションのクエリに処理の機会を与える
+# ダウンロードできるバックアップZIPの上限。st.download_buttonはファイル全体をメモリに読み込んで配信するため、
+# これを超えるZIPは作成時にエラーにする（既定値はStreamlitのアップロード上限 server.maxUploadSize と同じ200MB）
+BACKUP_DOWNLOAD_MAX_BYTES = int(os.environ.get('CT_BACKUP_MAX_MB', '200')) * 1024 * 1024
 
-def create_backup_zip():
-    """バックアップZIPファイルを作成"""
+def create_db_snapshot():
+    """SQLiteのオンラインバックアップAPIでDBのスナップショットを一時ファイルに作成し、(パス, 時点)を返す
+
+    BACKUP_PAGES_PER_STEPページずつコピーし、ステップ間で待機するため他のセッションを止めない。
+    コピー元の接続で読み取りトランザクションを開いたままにし、開始時点の内容に固定する
+    （WALモードのため書き込みは妨げず、書き込みがあってもコピーが最初からやり直しにならない）。
+    呼び出し側で一時ファイルを削除すること。
+    """
+    fd, snapshot_path = tempfile.mkstemp(prefix='ct_snapshot_', suffix='.db')
+    os.close(fd)
+    source = sqlite3.connect(DB_PATH, isolation_level=None)
     try:
-        # データをエクスポート
-        data, error = export_all_data()
-        if data is None:
-            return None, error
-        
-        # メモリ上でZIPファイルを作成
-        zip_buffer = BytesIO()
-        
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # JSONデータを追加
-            json_data = json.dumps(data, ensure_ascii=False, indent=2)
-            zip_file.writestr('backup_data.json', json_data.encode('utf-8'))
+        snapshot = sqlite3.connect(snapshot_path)
+        try:
+            taken_at = _begin_read_snapshot(source)
+            source.backup(
+                snapshot, pages=BACKUP_PAGES_PER_STEP,
+                progress=lambda status, remaining, total: time.sleep(BACKUP_STEP_PAUSE))
+            # 単体のファイルとして扱えるよう、WALからロールバックジャーナルに戻しておく
+            snapshot.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            snapshot.close()
+    except Exception:
+        os.remove(snapshot_path)
+        raise
+    finally:
+        source.close()
+    return snapshot_path, taken_at
+
+def get_last_backup():
+    """直近のバックアップの記録を取得（なければNone）"""
+    columns = ('backup_id', 'backup_type', 'base_backup_id', 'since', 'high_water_mark', 'created_at')
+    row = get_db_connection().execute(
+        f"SELECT {', '.join(columns)} FROM backup_log ORDER BY id DESC LIMIT 1").fetchone()
+    return dict(zip(columns, row)) if row else None
+
+def record_backup(backup_id, backup_type, base_backup_id, since, high_water_mark):
+    """バックアップを履歴に記録（フルバックアップの場合、それ以前の削除の記録は不要になるため消去）"""
+    with db_transaction(invalidate_cache=False) as cursor:
+        cursor.execute('''
+            INSERT INTO backup_log (backup_id, backup_type, base_backup_id, since, high_water_mark)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (backup_id, backup_type, base_backup_id, since, high_water_mark))
+        if backup_type == 'full':
+            cursor.execute("DELETE FROM deleted_rows WHERE deleted_at < ?", (_backup_cutoff(high_water_mark),))
+
+def create_backup_zip(incremental=False):
+    """バックアップZIPファイルを一時ファイルに作成し、そのパスを返す（呼び出し側で削除すること）
+
+    フルバックアップはJSONとSQLiteファイルを同じスナップショットから作成する。
+    incrementalを指定すると、前回のバックアップ以降の変更だけをJSONに含む差分バックアップを作成する。
+    ZIPはディスク上に書き出すため、作成中のメモリ使用量はデータベースの大きさによらず一定。
+    ダウンロード時はZIP全体がメモリに読み込まれるため、BACKUP_DOWNLOAD_MAX_BYTESを超える場合は
+    履歴に記録せずにエラーを返す。
+    """
+    backup_type = 'incremental' if incremental else 'full'
+    backup_info = {'backup_id': secrets.token_hex(8), 'base_backup_id': None}
+    since = None
+    if incremental:
+        last_backup = get_last_backup()
+        if last_backup is None:
+            return None, "差分の基準となるバックアップがありません。先にフルバックアップを作成してください"
+        backup_info['base_backup_id'] = last_backup['backup_id']
+        since = last_backup['high_water_mark']
+    
+    snapshot_path = None
+    zip_path = None
+    try:
+        if not incremental:
+            snapshot_path, taken_at = create_db_snapshot()
+        fd, zip_path = tempfile.mkstemp(prefix='ct_backup_', suffix='.zip')
+        os.close(fd)
+        
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            # JSONデータを追加（ZIP内のファイルへ直接書き出す）
+            with zip_file.open('backup_data.json', 'w', force_zip64=True) as member:
+                with TextIOWrapper(member, encoding='utf-8') as json_file:
+                    if incremental:
+                        # 差分は変更日時のインデックスで変更行だけを読むため、スナップショットは作らない
+                        high_water_mark = write_export_json(json_file, since=since, extra_info=backup_info)
+                    else:
+                        snapshot = sqlite3.connect(snapshot_path)
+                        try:
+                            high_water_mark = write_export_json(json_file, snapshot, high_water_mark=taken_at,
+                                                                extra_info=backup_info)
+                        finally:
+                            snapshot.close()
             
-            # SQLiteファイルも追加
-            try:
-                zip_file.write('medical_ct.db', 'medical_ct.db')
-            except FileNotFoundError:
-                # SQLiteファイルが見つからない場合はスキップ
-                pass
+            if incremental:
+                contents = f"""- backup_data.json: 前回のバックアップ（{since} UTC）以降に追加・更新されたデータと削除の記録
+  （画像は追加された分のみ）"""
+                restore_steps = """1. 管理画面の「フル＋差分バックアップから復元」で、基準のフルバックアップと
+   それ以降の差分バックアップをすべて選択して復元"""
+            else:
+                # SQLiteファイルを追加（スナップショットのため書き込み中でも壊れない）
+                zip_file.write(snapshot_path, 'medical_ct.db')
+                contents = """- backup_data.json: 全データのJSON形式
+  （画像は images に1件ずつ格納され、各データの画像欄は "image:<id>" でそれを参照します）
+- medical_ct.db: SQLiteデータベースファイル（存在する場合）"""
+                restore_steps = """1. backup_data.jsonを使用してデータを復元
+2. または medical_ct.db を直接利用
+3. 差分バックアップと組み合わせる場合は、管理画面の「フル＋差分バックアップから復元」を使用"""
             
             # README追加
             readme_content = f"""
-How to CT Medical System - データバックアップ
+How to CT Medical System - データバックアップ（{'差分' if incremental else 'フル'}）
 
 エクスポート日時: {datetime.now().strftime('%Y年%m月%d日 %H:%M:%S')}
+バックアップ時点: {high_water_mark} UTC
+バックアップID: {backup_info['backup_id']}{f"（基準: {backup_info['base_backup_id']}）" if incremental else ""}
 
 含まれるファイル:
-- backup_data.json: 全データのJSON形式
-- medical_ct.db: SQLiteデータベースファイル（存在する場合）
+{contents}
 
 復元方法:
-1. backup_data.jsonを使用してデータを復元
-2. または medical_ct.db を直接利用
+{restore_steps}
 
 注意事項:
 - ユーザーのパスワードは含まれていません
@@ -807,148 +1917,160 @@ How to CT Medical System - データバックアップ
 """
             zip_file.writestr('README.txt', readme_content.encode('utf-8'))
         
-        zip_buffer.seek(0)
-        return zip_buffer.getvalue(), "OK"
+        zip_size = os.path.getsize(zip_path)
+        if zip_size > BACKUP_DOWNLOAD_MAX_BYTES:
+            os.remove(zip_path)
+            return None, (f"バックアップファイルが大きすぎます（{zip_size / (1024 * 1024):.0f}MB、"
+                          f"上限 {BACKUP_DOWNLOAD_MAX_BYTES / (1024 * 1024):.0f}MB）。"
+                          "環境変数 CT_BACKUP_MAX_MB で上限を変更してください")
+        
+        record_backup(backup_info['backup_id'], backup_type, backup_info['base_backup_id'], since, high_water_mark)
+        return zip_path, "OK"
         
     except Exception as e:
+        if zip_path and os.path.exists(zip_path):
+            os.remove(zip_path)
         return None, f"バックアップファイル作成中にエラーが発生しました: {str(e)}"
+    finally:
+        if snapshot_path and os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
 
 def restore_from_json(json_data):
     """JSONデータから復元（完全置換モード）"""
     try:
-        conn = sqlite3.connect('medical_ct.db')
-        cursor = conn.cursor()
-        
-        # 復元開始
-        restored_counts = {
-            'sicks': 0,
-            'forms': 0,
-            'protocols': 0,
-            'deleted_sicks': 0,
-            'deleted_forms': 0,
-            'deleted_protocols': 0
-        }
-        
-        # 移行タイプをチェック
-        migration_type = json_data.get('export_info', {}).get('migration_type', 'unknown')
-        
-        if migration_type == 'complete_replacement':
-            print("🔄 完全置換モードで復元開始...")
+        # 全件を一つのトランザクションで投入（失敗時はロールバック）
+        with db_transaction() as cursor:
+        
+            # 復元開始
+            restored_counts = {
+                'sicks': 0,
+                'forms': 0,
+                'protocols': 0,
+                'deleted_sicks': 0,
+                'deleted_forms': 0,
+                'deleted_protocols': 0
+            }
+        
+            # 移行タイプをチェック
+            migration_type = json_data.get('export_info', {}).get('migration_type', 'unknown')
+        
+            if migration_type == 'complete_replacement':
+                print("🔄 完全置換モードで復元開始...")
             
-            # 既存データの件数を記録
-            cursor.execute('SELECT COUNT(*) FROM sicks')
-            restored_counts['deleted_sicks'] = cursor.fetchone()[0]
+                # 既存データの件数を記録
+                cursor.execute('SELECT COUNT(*) FROM sicks')
+                restored_counts['deleted_sicks'] = cursor.fetchone()[0]
             
-            cursor.execute('SELECT COUNT(*) FROM forms')
-            restored_counts['deleted_forms'] = cursor.fetchone()[0]
+                cursor.execute('SELECT COUNT(*) FROM forms')
+                restored_counts['deleted_forms'] = cursor.fetchone()[0]
             
-            cursor.execute('SELECT COUNT(*) FROM protocols')
-            restored_counts['deleted_protocols'] = cursor.fetchone()[0]
+                cursor.execute('SELECT COUNT(*) FROM protocols')
+                restored_counts['deleted_protocols'] = cursor.fetchone()[0]
             
-            print(f"📊 削除予定データ - 疾患:{restored_counts['deleted_sicks']}件, お知らせ:{restored_counts['deleted_forms']}件, プロトコル:{restored_counts['deleted_protocols']}件")
+                print(f"📊 削除予定データ - 疾患:{restored_counts['deleted_sicks']}件, お知らせ:{restored_counts['deleted_forms']}件, プロトコル:{restored_counts['deleted_protocols']}件")
             
-            # 既存データを完全削除（ユーザーデータとセッションは保持）
-            print("🗑️ 既存データを削除中...")
-            cursor.execute('DELETE FROM sicks')
-            cursor.execute('DELETE FROM forms') 
-            cursor.execute('DELETE FROM protocols')
+                # 既存データを完全削除（ユーザーデータとセッションは保持）
+                print("🗑️ 既存データを削除中...")
+                cursor.execute('DELETE FROM sicks')
+                cursor.execute('DELETE FROM forms') 
+                cursor.execute('DELETE FROM protocols')
             
-            print("✅ 既存データ削除完了")
-        else:
-            print("➕ 追加モードで復元開始...")
+                print("✅ 既存データ削除完了")
+            else:
+                print("➕ 追加モードで復元開始...")
         
-        # 疾患データの投入
-        if 'sicks' in json_data and json_data['sicks']:
-            print(f"📋 Laravel版疾患データを投入中... ({len(json_data['sicks'])}件)")
+            # 疾患データの投入
+            if 'sicks' in json_data and json_data['sicks']:
+                print(f"📋 Laravel版疾患データを投入中... ({len(json_data['sicks'])}件)")
             
-            for i, sick in enumerate(json_data['sicks']):
-                try:
-                    cursor.execute('''
-                        INSERT INTO sicks (
-                            diesease, diesease_text, keyword, protocol, protocol_text,
-                            processing, processing_text, contrast, contrast_text,
-                            diesease_img, protocol_img, processing_img, contrast_img
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        sick.get('diesease', ''),
-                        sick.get('diesease_text', ''),
-                        sick.get('keyword', ''),
-                        sick.get('protocol', ''),
-                        sick.get('protocol_text', ''),
-                        sick.get('processing', ''),
-                        sick.get('processing_text', ''),
-                        sick.get('contrast', ''),
-                        sick.get('contrast_text', ''),
-                        '',  # 画像データは空文字
-                        '',  # 画像データは空文字
-                        '',  # 画像データは空文字
-                        ''   # 画像データは空文字
-                    ))
-                    restored_counts['sicks'] += 1
+                for i, sick in enumerate(json_data['sicks']):
+                    try:
+                        cursor.execute('''
+                            INSERT INTO sicks (
+                                diesease, diesease_text, keyword, protocol, protocol_text,
+                                processing, processing_text, contrast, contrast_text,
+                                diesease_img, protocol_img, processing_img, contrast_img
+                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        ''', (
+                            sick.get('diesease', ''),
+                            sick.get('diesease_text', ''),
+                            sick.get('keyword', ''),
+                            sick.get('protocol', ''),
+                            sick.get('protocol_text', ''),
+                            sick.get('processing', ''),
+                            sick.get('processing_text', ''),
+                            sick.get('contrast', ''),
+                            sick.get('contrast_text', ''),
+                            '',  # 画像データは空文字
+                            '',  # 画像データは空文字
+                            '',  # 画像データは空文字
+                            ''   # 画像データは空文字
+                        ))
+                        restored_counts['sicks'] += 1
                     
-                    # 進捗表示
-                    if (i + 1) % 10 == 0 or (i + 1) == len(json_data['sicks']):
-                        print(f"   進捗: {i + 1}/{len(json_data['sicks'])}件")
+                        # 進捗表示
+                        if (i + 1) % 10 == 0 or (i + 1) == len(json_data['sicks']):
+                            print(f"   進捗: {i + 1}/{len(json_data['sicks'])}件")
                         
-                except sqlite3.Error as e:
-                    print(f"   ⚠️ 疾患データスキップ: {sick.get('diesease', 'Unknown')} - {e}")
+                    except sqlite3.Error as e:
+                        print(f"   ⚠️ 疾患データスキップ: {sick.get('diesease', 'Unknown')} - {e}")
             
-            print(f"✅ 疾患データ投入完了: {restored_counts['sicks']}件")
+                print(f"✅ 疾患データ投入完了: {restored_counts['sicks']}件")
         
-        # お知らせデータの投入
-        if 'forms' in json_data and json_data['forms']:
-            print(f"📢 Laravel版お知らせデータを投入中... ({len(json_data['forms'])}件)")
+            # お知らせデータの投入
+            if 'forms' in json_data and json_data['forms']:
+                print(f"📢 Laravel版お知らせデータを投入中... ({len(json_data['forms'])}件)")
             
-            for i, form in enumerate(json_data['forms']):
-                try:
-                    cursor.execute('''
-                        INSERT INTO forms (title, main, post_img)
-                        VALUES (?, ?, ?)
-                    ''', (
-                        form.get('title', ''),
-                        form.get('main', ''),
-                        ''  # 画像データは空文字
-                    ))
-                    restored_counts['forms'] += 1
+                for i, form in enumerate(json_data['forms']):
+                    try:
+                        cursor.execute('''
+                            INSERT INTO forms (title, main, post_img)
+                            VALUES (?, ?, ?)
+                        ''', (
+                            form.get('title', ''),
+                            form.get('main', ''),
+                            ''  # 画像データは空文字
+                        ))
+                        restored_counts['forms'] += 1
                     
-                    # 進捗表示
-                    if (i + 1) % 5 == 0 or (i + 1) == len(json_data['forms']):
-                        print(f"   進捗: {i + 1}/{len(json_data['forms'])}件")
+                        # 進捗表示
+                        if (i + 1) % 5 == 0 or (i + 1) == len(json_data['forms']):
+                            print(f"   進捗: {i + 1}/{len(json_data['forms'])}件")
                         
-                except sqlite3.Error as e:
-                    print(f"   ⚠️ お知らせデータスキップ: {form.get('title', 'Unknown')} - {e}")
+                    except sqlite3.Error as e:
+                        print(f"   ⚠️ お知らせデータスキップ: {form.get('title', 'Unknown')} - {e}")
             
-            print(f"✅ お知らせデータ投入完了: {restored_counts['forms']}件")
+                print(f"✅ お知らせデータ投入完了: {restored_counts['forms']}件")
         
-        # CTプロトコルデータの投入
-        if 'protocols' in json_data and json_data['protocols']:
-            print(f"🔧 Laravel版プロトコルデータを投入中... ({len(json_data['protocols'])}件)")
+            # CTプロトコルデータの投入
+            if 'protocols' in json_data and json_data['protocols']:
+                print(f"🔧 Laravel版プロトコルデータを投入中... ({len(json_data['protocols'])}件)")
             
-            for i, protocol in enumerate(json_data['protocols']):
-                try:
-                    cursor.execute('''
-                        INSERT INTO protocols (category, title, content, protocol_img)
-                        VALUES (?, ?, ?, ?)
-                    ''', (
-                        protocol.get('category', ''),
-                        protocol.get('title', ''),
-                        protocol.get('content', ''),
-                        ''  # 画像データは空文字
-                    ))
-                    restored_counts['protocols'] += 1
+                for i, protocol in enumerate(json_data['protocols']):
+                    try:
+                        cursor.execute('''
+                            INSERT INTO protocols (category, title, content, protocol_img)
+                            VALUES (?, ?, ?, ?)
+                        ''', (
+                            protocol.get('category', ''),
+                            protocol.get('title', ''),
+                            protocol.get('content', ''),
+                            ''  # 画像データは空文字
+                        ))
+                        restored_counts['protocols'] += 1
                     
-                    # 進捗表示
-                    if (i + 1) % 5 == 0 or (i + 1) == len(json_data['protocols']):
-                        print(f"   進捗: {i + 1}/{len(json_data['protocols'])}件")
+                        # 進捗表示
+                        if (i + 1) % 5 == 0 or (i + 1) == len(json_data['protocols']):
+                            print(f"   進捗: {i + 1}/{len(json_data['protocols'])}件")
                         
-                except sqlite3.Error as e:
-                    print(f"   ⚠️ プロトコルデータスキップ: {protocol.get('title', 'Unknown')} - {e}")
+                    except sqlite3.Error as e:
+                        print(f"   ⚠️ プロトコルデータスキップ: {protocol.get('title', 'Unknown')} - {e}")
+            
+                print(f"✅ プロトコルデータ投入完了: {restored_counts['protocols']}件")
             
-            print(f"✅ プロトコルデータ投入完了: {restored_counts['protocols']}件")
+            # 完全置換で削除した行からしか参照されていない画像を削除
+            purge_unused_images(cursor)
         
-        # コミットして終了
-        conn.commit()
-        conn.close()
         
         print("\n🎉 データ移行完了！")
         print(f"📊 復元サマリー:")
@@ -965,12 +2087,91 @@ def restore_from_json(json_data):
         return True, restored_counts
         
     except Exception as e:
-        if 'conn' in locals():
-            conn.rollback()
-            conn.close()
         print(f"❌ 復元エラー: {e}")
         return False, f"復元中にエラーが発生しました: {str(e)}"
 
+def _upsert_rows(cursor, table, records):
+    """IDを保ったまま行を追加・上書き（更新トリガーが動くよう、置き換えではなくUPDATEで上書きする）"""
+    table_columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+    for record in records:
+        columns = [column for column in table_columns if column in record]
+        values = [(record[column] or None) if column in ('created_at', 'updated_at') else record[column] for column in columns]
+        assignments = ", ".join(f"{column} = excluded.{column}" for column in columns if column != 'id')
+        cursor.execute(f'''
+            INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})
+            ON CONFLICT(id) DO UPDATE SET {assignments}
+        ''', values)
+
+def restore_backup_chain(backups):
+    """フルバックアップと差分バックアップから復元（IDと画像を保ったまま全データを置き換える）
+
+    backupsはバックアップJSON（version 1.2以降）のリスト（順不同）。フルバックアップ1件と、
+    それ以降の差分バックアップを含める。差分は基準のバックアップID（base_backup_id）をたどって
+    作成順に適用し、途中が欠けていればエラーにする。
+    復元前の変更記録は復元後のデータと対応しないため、バックアップ履歴と削除の記録は消去する。
+    """
+    types = [backup.get('export_info', {}).get('backup_type') for backup in backups]
+    if any(backup_type not in ('full', 'incremental') for backup_type in types):
+        return False, "version 1.2より前のバックアップは指定できません（「データの復元」を使用してください）"
+    if types.count('full') != 1:
+        return False, "フルバックアップを1件だけ指定してください"
+    
+    deltas_by_base = {}
+    for backup in backups:
+        if backup['export_info']['backup_type'] == 'incremental':
+            base_backup_id = backup['export_info']['base_backup_id']
+            if base_backup_id in deltas_by_base:
+                return False, f"同じバックアップ（{base_backup_id}）を基準にした差分バックアップが複数あります"
+            deltas_by_base[base_backup_id] = backup
+    chain = [backups[types.index('full')]]
+    while chain[-1]['export_info']['backup_id'] in deltas_by_base:
+        chain.append(deltas_by_base.pop(chain[-1]['export_info']['backup_id']))
+    if deltas_by_base:
+        return False, "つながらない差分バックアップがあります（途中の差分が欠けているか、別のフルバックアップの差分です）"
+    
+    try:
+        with db_transaction() as cursor:
+            for table in BACKUP_TRACKED_TABLES:
+                cursor.execute(f"DELETE FROM {table}")
+            
+            # 各バックアップについて、削除を先に適用してから追加・更新を適用する
+            # （バックアップに含まれる行はバックアップ時点で存在していたため）
+            for backup in chain:
+                for tombstone in backup.get('deleted_rows', []):
+                    if tombstone['table_name'] in BACKUP_TRACKED_TABLES:
+                        cursor.execute(f"DELETE FROM {tombstone['table_name']} WHERE id = ?", (tombstone['row_id'],))
+                for image in backup.get('images', []):
+                    image_bytes = base64.b64decode(image['data'])
+                    cursor.execute('''
+                        INSERT OR IGNORE INTO images (id, data, size, created_at)
+                        VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+                    ''', (image['id'], sqlite3.Binary(image_bytes), len(image_bytes), image.get('created_at') or None))
+                for table in BACKUP_TRACKED_TABLES:
+                    _upsert_rows(cursor, table, backup.get(table, []))
+            
+            # 参照されなくなった画像を削除し、縮小版を作り直す
+            purge_unused_images(cursor)
+            backfill_image_renditions(cursor)
+            
+            cursor.execute("DELETE FROM deleted_rows")
+            cursor.execute("DELETE FROM backup_log")
+            
+            restored_counts = {'backups': len(chain)}
+            for table in BACKUP_TRACKED_TABLES + ('images',):
+                restored_counts[table] = cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        
+        return True, restored_counts
+        
+    except Exception as e:
+        return False, f"復元中にエラーが発生しました: {str(e)}"
+
+def read_backup_file(uploaded_file):
+    """アップロードされたバックアップファイル（JSONまたはZIP）からバックアップJSONを読み込む"""
+    if uploaded_file.name.lower().endswith('.zip'):
+        with zipfile.ZipFile(uploaded_file, 'r') as zip_file:
+            return json.loads(zip_file.read('backup_data.json').decode('utf-8'))
+    return json.loads(uploaded_file.read().decode('utf-8'))
+
 def is_admin_user():
     """現在のユーザーが管理者かどうかチェック"""
     if 'user' not in st.session_state:
@@ -1012,25 +2213,46 @@ def validate_email(email):
     
     return True, "OK"
 
+USER_LIST_SQL = "SELECT id, name, email, created_at FROM users ORDER BY created_at DESC"
+
 def get_all_users():
     """全ユーザー情報を取得（管理者用）"""
-    conn = sqlite3.connect('medical_ct.db')
-    df = pd.read_sql_query("SELECT id, name, email, created_at FROM users ORDER BY created_at DESC", conn)
-    conn.close()
-    return df
+    return pd.read_sql_query(USER_LIST_SQL, get_db_connection())
 
 def delete_user(user_id):
     """ユーザーを削除（管理者用）"""
-    conn = sqlite3.connect('medical_ct.db')
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with db_transaction() as cursor:
+        cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
 
 def admin_register_user(name, email, password):
     """管理者による新規ユーザー登録"""
     return register_user(name, email, password)  # 既存の関数を再利用
 
+# ページ送り
+SEARCH_PAGE_SIZE = 20
+LIST_PAGE_SIZE = 20
+HOME_NOTICE_COUNT = 7
+
+def show_pagination(state_key, total_count, page_size):
+    """ページ送りボタンを表示し、現在のページ番号（0始まり）を返す"""
+    page_count = max(1, (total_count + page_size - 1) // page_size)
+    page = min(st.session_state.get(state_key, 0), page_count - 1)
+    
+    if page_count > 1:
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col1:
+            if st.button("◀ 前へ", key=f"{state_key}_prev", disabled=page == 0, use_container_width=True):
+                st.session_state[state_key] = page - 1
+                st.rerun()
+        with col2:
+            st.markdown(f'<div style="text-align: center;">{page + 1} / {page_count} ページ（全{total_count}件）</div>', unsafe_allow_html=True)
+        with col3:
+            if st.button("次へ ▶", key=f"{state_key}_next", disabled=page >= page_count - 1, use_container_width=True):
+                st.session_state[state_key] = page + 1
+                st.rerun()
+    
+    return page
+
 # ページ関数定義
 def show_welcome_page():
     """ウェルカムページ"""
@@ -1076,28 +2298,11 @@ def show_login_page():
                         }
                         st.session_state.page = "home"
                         
-                        # ログイン成功時にセッション情報をDBに保存
+                        # ログイン成功時にセッショントークンを発行してDBに保存（Cookieへはsync_session_cookieで書き込む）
+                        token = create_session_token()
+                        st.session_state.session_token = token
                         session_data = {'page': 'home'}
-                        save_result = save_session_to_db(user[0], session_data)
-                        
-                        # デバッグ: セッション保存確認
-                        st.success(f"ログインしました - ユーザーID: {user[0]}, メール: {user[2]}")
-                        if save_result:
-                            st.info("✅ セッション情報を保存しました")
-                        else:
-                            st.error("❌ セッション保存に失敗しました")
-                        
-                        # 保存されたセッションを確認
-                        try:
-                            conn = sqlite3.connect('medical_ct.db')
-                            cursor = conn.cursor()
-                            cursor.execute("SELECT COUNT(*) FROM user_sessions WHERE user_id = ?", (user[0],))
-                            count = cursor.fetchone()[0]
-                            st.info(f"保存確認: ユーザーID {user[0]} のセッション数 = {count}")
-                            conn.close()
-                        except Exception as e:
-                            st.error(f"保存確認エラー: {e}")
-                        
+                        save_session_to_db(token, user[0], session_data, flush=True)
                         st.rerun()
                     else:
                         st.error("メールアドレスまたはパスワードが間違っています")
@@ -1134,13 +2339,11 @@ def show_home_page():
         st.rerun()
     
     st.markdown('<h3 class="section-title">最新のお知らせ</h3>', unsafe_allow_html=True)
-    df_forms = get_all_forms()
-    if not df_forms.empty:
-        latest_notices = df_forms.head(7)
+    latest_notices = get_latest_forms(HOME_NOTICE_COUNT)
+    if not latest_notices.empty:
         for idx, row in latest_notices.iterrows():
             with st.expander(f"{row['title']}"):
-                preview_text = row['main'][:150] + "..." if len(str(row['main'])) > 150 else row['main']
-                display_rich_content(preview_text)
+                display_rich_content(preview_text(row['preview'], 150))
                 st.caption(f"投稿日: {row['created_at']}")
                 if st.button("詳細を見る", key=f"home_notice_preview_{row['id']}"):
                     st.session_state.selected_notice_id = row['id']
@@ -1167,25 +2370,29 @@ def show_search_page():
     with col2:
         if st.button("全疾患一覧を表示", key="search_show_all"):
             st.session_state.show_all_diseases = True
+            st.session_state.all_diseases_page = 0
             # 検索結果をクリア
-            if 'search_results' in st.session_state:
-                del st.session_state.search_results
+            if 'search_term' in st.session_state:
+                del st.session_state.search_term
             st.rerun()
     
-    # 検索実行と結果保存
+    # 検索実行（検索語を保存し、結果はページごとに取得）
     if submitted and search_term:
-        df = search_sicks(search_term)
-        st.session_state.search_results = df
+        st.session_state.search_term = search_term
+        st.session_state.search_page = 0
         # 全疾患表示フラグをクリア
         if 'show_all_diseases' in st.session_state:
             del st.session_state.show_all_diseases
         st.rerun()
     
     # 検索結果表示
-    if 'search_results' in st.session_state:
-        df = st.session_state.search_results
-        if not df.empty:
-            st.success(f"{len(df)}件の検索結果が見つかりました")
+    if 'search_term' in st.session_state:
+        total_count = count_search_sicks(st.session_state.search_term)
+        if total_count > 0:
+            st.success(f"{total_count}件の検索結果が見つかりました（関連度順）")
+            
+            page = show_pagination('search_page', total_count, SEARCH_PAGE_SIZE)
+            df = search_sicks(st.session_state.search_term, limit=SEARCH_PAGE_SIZE, offset=page * SEARCH_PAGE_SIZE)
             
             for idx, row in df.iterrows():
                 st.markdown(f'<div class="search-result">', unsafe_allow_html=True)
@@ -1198,8 +2405,7 @@ def show_search_page():
                     if row['protocol']:
                         st.markdown(f"**撮影プロトコル:** {row['protocol']}")
                     
-                    preview_text = row['diesease_text'][:150] + "..." if len(str(row['diesease_text'])) > 150 else row['diesease_text']
-                    display_rich_content(preview_text)
+                    display_rich_content(preview_text(row['preview'], 150))
                 
                 with col2:
                     if st.button("詳細を見る", key=f"search_detail_{row['id']}"):
@@ -1212,24 +2418,27 @@ def show_search_page():
             
             # 検索結果をクリアするボタン
             if st.button("検索結果をクリア", key="clear_search_results"):
-                if 'search_results' in st.session_state:
-                    del st.session_state.search_results
+                if 'search_term' in st.session_state:
+                    del st.session_state.search_term
                 st.rerun()
         else:
             st.info("該当する疾患が見つかりませんでした")
             
             # 検索結果をクリアするボタン
             if st.button("検索結果をクリア", key="clear_no_results"):
-                if 'search_results' in st.session_state:
-                    del st.session_state.search_results
+                if 'search_term' in st.session_state:
+                    del st.session_state.search_term
                 st.rerun()
     
     # 全疾患表示
     elif st.session_state.get('show_all_diseases', False):
-        df = get_all_sicks()
-        if not df.empty:
+        total_count = count_sicks()
+        if total_count > 0:
             st.subheader("全疾患一覧")
             
+            page = show_pagination('all_diseases_page', total_count, LIST_PAGE_SIZE)
+            df = get_sick_list(limit=LIST_PAGE_SIZE, offset=page * LIST_PAGE_SIZE)
+            
             for idx, row in df.iterrows():
                 st.markdown(f'<div class="search-result">', unsafe_allow_html=True)
                 col1, col2 = st.columns([3, 1])
@@ -1265,7 +2474,8 @@ def show_detail_page():
             st.rerun()
         return
     
-    sick_data = get_sick_by_id(st.session_state.selected_sick_id)
+    # 本文のみ先に取得し、画像は各タブで表示を選んだときに読み込む
+    sick_data = get_sick_detail(st.session_state.selected_sick_id)
     if not sick_data:
         st.error("疾患データが見つかりません")
         if st.button("検索に戻る", key="detail_back_not_found"):
@@ -1296,9 +2506,8 @@ def show_detail_page():
         display_rich_content(sick_data[2])
         
         # 疾患画像表示
-        if sick_data[10]:  # diesease_img
-            st.markdown("**疾患関連画像:**")
-            display_image_with_caption(sick_data[10], "疾患画像")
+        if sick_data[10]:  # has_diesease_img
+            show_lazy_sick_image(sick_data[0], "diesease_img", "疾患関連画像", "疾患画像")
         
         st.markdown('</div>', unsafe_allow_html=True)
     
@@ -1313,9 +2522,8 @@ def show_detail_page():
             st.info("撮影プロトコルの詳細が未設定です")
         
         # 撮影プロトコル画像表示
-        if sick_data[11]:  # protocol_img
-            st.markdown("**撮影プロトコル画像:**")
-            display_image_with_caption(sick_data[11], "撮影プロトコル画像")
+        if sick_data[11]:  # has_protocol_img
+            show_lazy_sick_image(sick_data[0], "protocol_img", "撮影プロトコル画像", "撮影プロトコル画像")
         
         st.markdown('</div>', unsafe_allow_html=True)
     
@@ -1330,9 +2538,8 @@ def show_detail_page():
             st.info("造影プロトコルの詳細が未設定です")
         
         # 造影プロトコル画像表示
-        if sick_data[13]:  # contrast_img
-            st.markdown("**造影プロトコル画像:**")
-            display_image_with_caption(sick_data[13], "造影プロトコル画像")
+        if sick_data[13]:  # has_contrast_img
+            show_lazy_sick_image(sick_data[0], "contrast_img", "造影プロトコル画像", "造影プロトコル画像")
         
         st.markdown('</div>', unsafe_allow_html=True)
     
@@ -1347,9 +2554,8 @@ def show_detail_page():
             st.info("画像処理の詳細が未設定です")
         
         # 画像処理画像表示
-        if sick_data[12]:  # processing_img
-            st.markdown("**画像処理画像:**")
-            display_image_with_caption(sick_data[12], "画像処理画像")
+        if sick_data[12]:  # has_processing_img
+            show_lazy_sick_image(sick_data[0], "processing_img", "画像処理画像", "画像処理画像")
         
         st.markdown('</div>', unsafe_allow_html=True)
     
@@ -1390,8 +2596,11 @@ def show_notices_page():
             st.session_state.page = "create_notice"
             st.rerun()
     
-    df = get_all_forms()
-    if not df.empty:
+    total_count = count_forms()
+    if total_count > 0:
+        page = show_pagination('notices_page', total_count, LIST_PAGE_SIZE)
+        df = get_form_list(limit=LIST_PAGE_SIZE, offset=page * LIST_PAGE_SIZE)
+        
         for idx, row in df.iterrows():
             st.markdown('<div class="notice-card">', unsafe_allow_html=True)
             col1, col2 = st.columns([4, 1])
@@ -1399,8 +2608,7 @@ def show_notices_page():
             with col1:
                 st.markdown(f"### {row['title']}")
                 # リッチテキストのプレビュー表示
-                preview_text = row['main'][:200] + "..." if len(str(row['main'])) > 200 else row['main']
-                display_rich_content(preview_text)
+                display_rich_content(preview_text(row['preview'], 200))
                 st.caption(f"作成日: {row['created_at']}")
             
             with col2:
@@ -1502,15 +2710,15 @@ def show_create_notice_page():
         if submitted:
             if title and main:
                 try:
-                    # 画像をBase64に変換
-                    notice_img_b64 = None
+                    # 画像を検証・変換
+                    notice_img_data = None
                     if notice_image is not None:
-                        notice_img_b64, error_msg = validate_and_process_image(notice_image)
-                        if notice_img_b64 is None:
+                        notice_img_data, error_msg = validate_and_process_image(notice_image)
+                        if notice_img_data is None:
                             st.error(f"お知らせ画像: {error_msg}")
                             return
                     
-                    add_form(title, main, notice_img_b64)
+                    add_form(title, main, notice_img_data)
                     st.success("お知らせを登録しました")
                     st.session_state.page = "notices"
                     st.rerun()
@@ -1584,16 +2792,16 @@ def show_edit_notice_page():
             if title and main:
                 try:
                     # 画像処理（既存画像を保持するか新しい画像に更新するか）
-                    notice_img_b64 = form_data[3]  # 既存画像
+                    notice_img_data = form_data[3]  # 既存画像
                     
                     # 新しい画像がアップロードされた場合のみ更新
                     if notice_image is not None:
-                        notice_img_b64, error_msg = validate_and_process_image(notice_image)
-                        if notice_img_b64 is None:
+                        notice_img_data, error_msg = validate_and_process_image(notice_image)
+                        if notice_img_data is None:
                             st.error(f"お知らせ画像: {error_msg}")
                             return
                     
-                    update_form(st.session_state.edit_notice_id, title, main, notice_img_b64)
+                    update_form(st.session_state.edit_notice_id, title, main, notice_img_data)
                     st.success("お知らせを更新しました")
                     st.session_state.selected_notice_id = st.session_state.edit_notice_id
                     st.session_state.page = "notice_detail"
@@ -1632,13 +2840,8 @@ def show_create_disease_page():
         keyword = st.text_input("症状・キーワード", placeholder="例：胸痛、背部痛、急性")
         disease_image = st.file_uploader("疾患関連画像をアップロード", type=['png', 'jpg', 'jpeg'], key="create_disease_img_upload",
                                         help="対応形式: PNG, JPEG, JPG（最大5MB）")
-        disease_img_b64 = None
         if disease_image:
-            disease_img_b64, error_msg = validate_and_process_image(disease_image)
-            if disease_img_b64 is None:
-                st.error(f"疾患画像: {error_msg}")
-            else:
-                st.image(disease_image, caption="疾患関連画像プレビュー", width=300)
+            st.image(disease_image, caption="疾患関連画像プレビュー", width=300)
         
         st.markdown("---")
         
@@ -1656,13 +2859,8 @@ def show_create_disease_page():
         
         protocol_image = st.file_uploader("撮影プロトコル画像をアップロード", type=['png', 'jpg', 'jpeg'], key="create_protocol_img_upload",
                                         help="対応形式: PNG, JPEG, JPG（最大5MB）")
-        protocol_img_b64 = None
         if protocol_image:
-            protocol_img_b64, error_msg = validate_and_process_image(protocol_image)
-            if protocol_img_b64 is None:
-                st.error(f"撮影プロトコル画像: {error_msg}")
-            else:
-                st.image(protocol_image, caption="撮影プロトコル画像プレビュー", width=300)
+            st.image(protocol_image, caption="撮影プロトコル画像プレビュー", width=300)
         
         st.markdown("---")
         
@@ -1680,13 +2878,8 @@ def show_create_disease_page():
         
         contrast_image = st.file_uploader("造影プロトコル画像をアップロード", type=['png', 'jpg', 'jpeg'], key="create_contrast_img_upload",
                                         help="対応形式: PNG, JPEG, JPG（最大5MB）")
-        contrast_img_b64 = None
         if contrast_image:
-            contrast_img_b64, error_msg = validate_and_process_image(contrast_image)
-            if contrast_img_b64 is None:
-                st.error(f"造影プロトコル画像: {error_msg}")
-            else:
-                st.image(contrast_image, caption="造影プロトコル画像プレビュー", width=300)
+            st.image(contrast_image, caption="造影プロトコル画像プレビュー", width=300)
         
         st.markdown("---")
         
@@ -1704,13 +2897,8 @@ def show_create_disease_page():
         
         processing_image = st.file_uploader("画像処理画像をアップロード", type=['png', 'jpg', 'jpeg'], key="create_processing_img_upload",
                                           help="対応形式: PNG, JPEG, JPG（最大5MB）")
-        processing_img_b64 = None
         if processing_image:
-            processing_img_b64, error_msg = validate_and_process_image(processing_image)
-            if processing_img_b64 is None:
-                st.error(f"画像処理画像: {error_msg}")
-            else:
-                st.image(processing_image, caption="画像処理画像プレビュー", width=300)
+            st.image(processing_image, caption="画像処理画像プレビュー", width=300)
         
         # フォーム送信
         col1, col2 = st.columns([1, 1])
@@ -1727,18 +2915,29 @@ def show_create_disease_page():
             st.error("疾患名と疾患詳細は必須項目です")
         else:
             try:
-                add_sick(
+                # アップロード画像は送信時にまとめて並列処理する
+                images = process_uploaded_images({
+                    "疾患画像": disease_image,
+                    "撮影プロトコル画像": protocol_image,
+                    "造影プロトコル画像": contrast_image,
+                    "画像処理画像": processing_image,
+                })
+                if images is None:
+                    return
+                
+                sick_id = add_sick(
                     disease_name, disease_text, keyword or "",
                     protocol or "", protocol_text or "",
                     processing or "", processing_text or "",
                     contrast or "", contrast_text or "",
-                    disease_img_b64, protocol_img_b64,
-                    processing_img_b64, contrast_img_b64
+                    images.get("疾患画像"), images.get("撮影プロトコル画像"),
+                    images.get("画像処理画像"), images.get("造影プロトコル画像")
                 )
                 
                 # 作成成功フラグを設定
                 st.session_state.disease_created = True
                 st.session_state.created_disease_name = disease_name
+                st.session_state.created_disease_id = sick_id
                 st.rerun()
                 
             except Exception as e:
@@ -1769,6 +2968,8 @@ def show_create_disease_page():
                     del st.session_state.disease_created
                 if 'created_disease_name' in st.session_state:
                     del st.session_state.created_disease_name
+                if 'created_disease_id' in st.session_state:
+                    del st.session_state.created_disease_id
                 st.session_state.page = "search"
                 st.rerun()
         
@@ -1779,27 +2980,25 @@ def show_create_disease_page():
                     del st.session_state.disease_created
                 if 'created_disease_name' in st.session_state:
                     del st.session_state.created_disease_name
+                if 'created_disease_id' in st.session_state:
+                    del st.session_state.created_disease_id
                 st.rerun()
         
         with col3:
             if st.button("👁️ 作成した疾患を確認", key="create_success_view_created", use_container_width=True):
-                # 作成した疾患の詳細ページに移動
-                # 最新の疾患データを取得
-                conn = sqlite3.connect('medical_ct.db')
-                cursor = conn.cursor()
-                cursor.execute("SELECT id FROM sicks WHERE diesease = ? ORDER BY created_at DESC LIMIT 1", 
-                              (st.session_state.get('created_disease_name', ''),))
-                result = cursor.fetchone()
-                conn.close()
+                # 作成した疾患の詳細ページに移動（IDは作成時に取得済み）
+                created_id = st.session_state.get('created_disease_id')
                 
-                if result:
-                    st.session_state.selected_sick_id = result[0]
+                if created_id:
+                    st.session_state.selected_sick_id = created_id
                     st.session_state.page = "detail"
                     # 成功フラグをクリア
                     if 'disease_created' in st.session_state:
                         del st.session_state.disease_created
                     if 'created_disease_name' in st.session_state:
                         del st.session_state.created_disease_name
+                    if 'created_disease_id' in st.session_state:
+                        del st.session_state.created_disease_id
                     st.rerun()
         
         # この場合は戻るボタンを表示しない
@@ -1971,35 +3170,24 @@ def show_edit_disease_page():
         else:
             try:
                 # 画像処理（既存画像を保持するか新しい画像に更新するか）
-                disease_img_b64 = sick_data[10]  # 既存画像
-                protocol_img_b64 = sick_data[11]
-                processing_img_b64 = sick_data[12]
-                contrast_img_b64 = sick_data[13]
+                disease_img_data = sick_data[10]  # 既存画像
+                protocol_img_data = sick_data[11]
+                processing_img_data = sick_data[12]
+                contrast_img_data = sick_data[13]
                 
-                # 新しい画像がアップロードされた場合のみ更新
-                if disease_image is not None:
-                    disease_img_b64, error_msg = validate_and_process_image(disease_image)
-                    if disease_img_b64 is None:
-                        st.error(f"疾患画像: {error_msg}")
-                        return
-                
-                if protocol_image is not None:
-                    protocol_img_b64, error_msg = validate_and_process_image(protocol_image)
-                    if protocol_img_b64 is None:
-                        st.error(f"撮影プロトコル画像: {error_msg}")
-                        return
-                
-                if contrast_image is not None:
-                    contrast_img_b64, error_msg = validate_and_process_image(contrast_image)
-                    if contrast_img_b64 is None:
-                        st.error(f"造影プロトコル画像: {error_msg}")
-                        return
-                
-                if processing_image is not None:
-                    processing_img_b64, error_msg = validate_and_process_image(processing_image)
-                    if processing_img_b64 is None:
-                        st.error(f"画像処理画像: {error_msg}")
-                        return
+                # 新しい画像がアップロードされた場合のみ更新（まとめて並列処理）
+                images = process_uploaded_images({
+                    "疾患画像": disease_image,
+                    "撮影プロトコル画像": protocol_image,
+                    "造影プロトコル画像": contrast_image,
+                    "画像処理画像": processing_image,
+                })
+                if images is None:
+                    return
+                disease_img_data = images.get("疾患画像", disease_img_data)
+                protocol_img_data = images.get("撮影プロトコル画像", protocol_img_data)
+                contrast_img_data = images.get("造影プロトコル画像", contrast_img_data)
+                processing_img_data = images.get("画像処理画像", processing_img_data)
                 
                 update_sick(
                     st.session_state.edit_sick_id,
@@ -2007,8 +3195,8 @@ def show_edit_disease_page():
                     protocol, protocol_text,
                     processing, processing_text,
                     contrast, contrast_text,
-                    disease_img_b64, protocol_img_b64,
-                    processing_img_b64, contrast_img_b64
+                    disease_img_data, protocol_img_data,
+                    processing_img_data, contrast_img_data
                 )
                 
                 st.success("疾患データを更新しました")
@@ -2062,8 +3250,7 @@ def show_protocols_page():
                 
                 with col1:
                     st.markdown(f"**[{row['category']}] {row['title']}**")
-                    preview_text = row['content'][:150] + "..." if len(str(row['content'])) > 150 else row['content']
-                    display_rich_content(preview_text)
+                    display_rich_content(preview_text(row['preview'], 150))
                     st.caption(f"更新日: {row['updated_at']}")
                 
                 with col2:
@@ -2086,22 +3273,26 @@ def show_protocols_page():
                 st.rerun()
         return
     
-    # カテゴリータブ表示
-    tabs = st.tabs(categories)
+    # カテゴリータブ表示（全カテゴリーを1回のクエリで取得し、件数をタブに表示）
+    protocol_lists = get_protocol_lists_by_category()
+    tabs = st.tabs([f"{category} ({len(protocol_lists.get(category, []))})" for category in categories])
     
     for i, category in enumerate(categories):
         with tabs[i]:
-            df = get_protocols_by_category(category)
+            category_df = protocol_lists.get(category)
+            total_count = len(category_df) if category_df is not None else 0
             
-            if not df.empty:
+            if total_count > 0:
+                page = show_pagination(f'protocols_page_{category}', total_count, LIST_PAGE_SIZE)
+                df = category_df.iloc[page * LIST_PAGE_SIZE:(page + 1) * LIST_PAGE_SIZE]
+                
                 for idx, row in df.iterrows():
                     st.markdown('<div class="protocol-section">', unsafe_allow_html=True)
                     col1, col2 = st.columns([4, 1])
                     
                     with col1:
                         st.markdown(f"### {row['title']}")
-                        preview_text = row['content'][:200] + "..." if len(str(row['content'])) > 200 else row['content']
-                        display_rich_content(preview_text)
+                        display_rich_content(preview_text(row['preview'], 200))
                         st.caption(f"作成日: {row['created_at']} | 更新日: {row['updated_at']}")
                     
                     with col2:
@@ -2248,20 +3439,21 @@ def show_create_protocol_page():
             st.error("タイトルとプロトコル内容は必須項目です")
         else:
             try:
-                # 画像をBase64に変換
-                protocol_img_b64 = None
+                # 画像を検証・変換
+                protocol_img_data = None
                 if protocol_image is not None:
-                    protocol_img_b64, error_msg = validate_and_process_image(protocol_image)
-                    if protocol_img_b64 is None:
+                    protocol_img_data, error_msg = validate_and_process_image(protocol_image)
+                    if protocol_img_data is None:
                         st.error(f"プロトコル画像: {error_msg}")
                         return
                 
-                add_protocol(category, title, content, protocol_img_b64)
+                protocol_id = add_protocol(category, title, content, protocol_img_data)
                 
                 # 作成成功フラグを設定
                 st.session_state.protocol_created = True
                 st.session_state.created_protocol_title = title
                 st.session_state.created_protocol_category = category
+                st.session_state.created_protocol_id = protocol_id
                 if 'default_category' in st.session_state:
                     del st.session_state.default_category
                 st.rerun()
@@ -2295,6 +3487,8 @@ def show_create_protocol_page():
                     del st.session_state.created_protocol_title
                 if 'created_protocol_category' in st.session_state:
                     del st.session_state.created_protocol_category
+                if 'created_protocol_id' in st.session_state:
+                    del st.session_state.created_protocol_id
                 st.session_state.page = "protocols"
                 st.rerun()
         
@@ -2307,20 +3501,17 @@ def show_create_protocol_page():
                     del st.session_state.created_protocol_title
                 if 'created_protocol_category' in st.session_state:
                     del st.session_state.created_protocol_category
+                if 'created_protocol_id' in st.session_state:
+                    del st.session_state.created_protocol_id
                 st.rerun()
         
         with col3:
             if st.button("👁️ 作成したプロトコルを確認", key="create_protocol_success_view", use_container_width=True):
-                # 作成したプロトコル詳細ページに移動
-                conn = sqlite3.connect('medical_ct.db')
-                cursor = conn.cursor()
-                cursor.execute("SELECT id FROM protocols WHERE title = ? AND category = ? ORDER BY created_at DESC LIMIT 1", 
-                              (st.session_state.get('created_protocol_title', ''), st.session_state.get('created_protocol_category', '')))
-                result = cursor.fetchone()
-                conn.close()
+                # 作成したプロトコル詳細ページに移動（IDは作成時に取得済み）
+                created_id = st.session_state.get('created_protocol_id')
                 
-                if result:
-                    st.session_state.selected_protocol_id = result[0]
+                if created_id:
+                    st.session_state.selected_protocol_id = created_id
                     st.session_state.page = "protocol_detail"
                     # 成功フラグをクリア
                     if 'protocol_created' in st.session_state:
@@ -2329,6 +3520,8 @@ def show_create_protocol_page():
                         del st.session_state.created_protocol_title
                     if 'created_protocol_category' in st.session_state:
                         del st.session_state.created_protocol_category
+                    if 'created_protocol_id' in st.session_state:
+                        del st.session_state.created_protocol_id
                     st.rerun()
         return
     
@@ -2413,16 +3606,16 @@ def show_edit_protocol_page():
             if title and content:
                 try:
                     # 画像処理（既存画像を保持するか新しい画像に更新するか）
-                    protocol_img_b64 = protocol_data[4]  # 既存画像
+                    protocol_img_data = protocol_data[4]  # 既存画像
                     
                     # 新しい画像がアップロードされた場合のみ更新
                     if protocol_image is not None:
-                        protocol_img_b64, error_msg = validate_and_process_image(protocol_image)
-                        if protocol_img_b64 is None:
+                        protocol_img_data, error_msg = validate_and_process_image(protocol_image)
+                        if protocol_img_data is None:
                             st.error(f"プロトコル画像: {error_msg}")
                             return
                     
-                    update_protocol(st.session_state.edit_protocol_id, category, title, content, protocol_img_b64)
+                    update_protocol(st.session_state.edit_protocol_id, category, title, content, protocol_img_data)
                     st.success("プロトコルを更新しました")
                     st.session_state.selected_protocol_id = st.session_state.edit_protocol_id
                     st.session_state.page = "protocol_detail"
@@ -2601,24 +3794,41 @@ def show_admin_page():
             - お知らせ（画像含む）
             - CTプロトコル（画像含む）
             - ユーザー情報（パスワード除く）
+            
+            差分バックアップには、前回のバックアップ以降に追加・更新・削除されたデータだけが含まれます。
             """)
+            last_backup = get_last_backup()
+            if last_backup:
+                backup_type_label = "フル" if last_backup['backup_type'] == 'full' else "差分"
+                st.caption(f"前回のバックアップ: {backup_type_label}（{last_backup['high_water_mark']} UTC 時点）")
+            else:
+                st.caption("前回のバックアップ: なし（差分バックアップの前にフルバックアップを作成してください）")
         
         with col2:
+            backup_mode = st.radio("バックアップの種類", ["フル", "差分"], horizontal=True, key="backup_mode",
+                                   disabled=last_backup is None)
+            incremental = backup_mode == "差分" and last_backup is not None
             if st.button("バックアップ作成", use_container_width=True, key="create_backup"):
                 with st.spinner("バックアップを作成中..."):
-                    backup_data, error = create_backup_zip()
+                    backup_path, error = create_backup_zip(incremental=incremental)
                     
-                    if backup_data:
+                    if backup_path:
                         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                        filename = f"ct_system_backup_{timestamp}.zip"
+                        filename = f"ct_system_backup_{'incremental_' if incremental else ''}{timestamp}.zip"
                         
-                        st.download_button(
-                            label="バックアップをダウンロード",
-                            data=backup_data,
-                            file_name=filename,
-                            mime="application/zip",
-                            use_container_width=True
-                        )
+                        # 一時ファイルからダウンロードボタンに渡し、渡し終えたら削除する
+                        # （ダウンロードボタンは内容をメモリに保持するため、大きさはcreate_backup_zipで制限している）
+                        try:
+                            with open(backup_path, 'rb') as backup_file:
+                                st.download_button(
+                                    label="バックアップをダウンロード",
+                                    data=backup_file,
+                                    file_name=filename,
+                                    mime="application/zip",
+                                    use_container_width=True
+                                )
+                        finally:
+                            os.remove(backup_path)
                         st.success("✅ バックアップが作成されました！")
                     else:
                         st.error(f"❌ {error}")
@@ -2706,14 +3916,59 @@ def show_admin_page():
                     except Exception as e:
                         st.error(f"❌ ファイルの処理中にエラーが発生しました: {str(e)}")
         
+        st.markdown("---")
+        
+        # フル＋差分バックアップからの復元
+        st.markdown("フル＋差分バックアップから復元")
+        
+        chain_files = st.file_uploader(
+            "フルバックアップと差分バックアップを選択",
+            type=['json', 'zip'],
+            accept_multiple_files=True,
+            key="restore_chain_files",
+            help="基準のフルバックアップ1件と、それ以降の差分バックアップをすべて選択してください（順不同）"
+        )
+        
+        if chain_files:
+            col1, col2 = st.columns([2, 1])
+            
+            with col1:
+                st.warning("""
+                ⚠️ **復元時の注意事項:**
+                - 疾患データ・お知らせ・CTプロトコルはバックアップ時点の内容に置き換わります（IDと画像も復元されます）
+                - ユーザーデータは復元されません
+                - 復元後は新しくフルバックアップを作成してください
+                """)
+            
+            with col2:
+                if st.button("ベースと差分を復元", use_container_width=True, key="restore_chain"):
+                    try:
+                        backups = [read_backup_file(chain_file) for chain_file in chain_files]
+                        with st.spinner("データを復元中..."):
+                            success, result = restore_backup_chain(backups)
+                        
+                        if success:
+                            st.success(f"✅ {result['backups']}件のバックアップから復元しました")
+                            st.info(f"""
+                            **📊 復元後のデータ:**
+                            - 疾患データ: {result['sicks']}件
+                            - お知らせ: {result['forms']}件
+                            - CTプロトコル: {result['protocols']}件
+                            - 画像: {result['images']}件
+                            """)
+                        else:
+                            st.error(f"❌ {result}")
+                    
+                    except Exception as e:
+                        st.error(f"❌ ファイルの処理中にエラーが発生しました: {str(e)}")
+        
         # システム情報
         st.markdown("---")
         st.markdown("システム情報")
         
         try:
             # データベース統計
-            conn = sqlite3.connect('medical_ct.db')
-            cursor = conn.cursor()
+            cursor = get_db_connection().cursor()
             
             cursor.execute("SELECT COUNT(*) FROM sicks")
             sick_count = cursor.fetchone()[0]
@@ -2727,8 +3982,6 @@ def show_admin_page():
             cursor.execute("SELECT COUNT(*) FROM users")
             user_count = cursor.fetchone()[0]
             
-            conn.close()
-            
             col1, col2, col3, col4 = st.columns(4)
             with col1:
                 st.metric("疾患データ", f"{sick_count}件")
@@ -2741,7 +3994,61 @@ def show_admin_page():
                 
         except Exception as e:
             st.error(f"システム情報の取得に失敗しました: {str(e)}")
-        
+
+        # ストレージ設定
+        st.markdown("ストレージ設定")
+        try:
+            settings = get_db_settings()
+            st.caption(f"プロファイル: {settings['profile']}（環境変数 CT_DB_PROFILE で変更）")
+            st.table(pd.DataFrame([
+                {'設定': 'journal_mode', '値': str(settings['journal_mode'])},
+                {'設定': 'busy_timeout', '値': f"{settings['busy_timeout']} ms"},
+                {'設定': 'synchronous', '値': str(settings['synchronous'])},
+                {'設定': 'mmap_size', '値': f"{settings['mmap_size'] / (1024 * 1024):.0f} MB"},
+                {'設定': 'cache_size', '値': f"{settings['cache_size']}" + ("（KiB指定）" if settings['cache_size'] < 0 else "（ページ数）")},
+                {'設定': 'schema_version', '値': f"{settings['schema_version']} {get_migration_description(settings['schema_version'])}（最新: {MIGRATIONS[-1][0]}）"},
+            ]))
+        except Exception as e:
+            st.error(f"ストレージ設定の取得に失敗しました: {str(e)}")
+
+        # インデックス確認
+        with st.expander("インデックス確認（EXPLAIN QUERY PLAN）"):
+            try:
+                plan_results = verify_query_plans()
+                failures = [result['query'] for result in plan_results if not result['ok']]
+                if failures:
+                    st.warning(f"インデックスを使用していない、または一時B-treeで並べ替えているクエリがあります: {', '.join(failures)}")
+                else:
+                    st.success("全てのクエリがインデックスを使用しています（全件走査・並べ替えは想定内のもののみ）")
+                st.dataframe(pd.DataFrame([
+                    {
+                        'クエリ': result['query'],
+                        'インデックス': "✅" if result['uses_index'] else ("➖ 全件走査（想定内）" if PLAN_FULL_SCAN in result['expected'] else "⚠️ 全件走査"),
+                        '並べ替え': "✅" if not result['temp_sort'] else ("➖ 一時B-tree（想定内）" if PLAN_TEMP_SORT in result['expected'] else "⚠️ 一時B-tree"),
+                        '実行計画': result['plan'],
+                    }
+                    for result in plan_results
+                ]), use_container_width=True, hide_index=True)
+            except Exception as e:
+                st.error(f"実行計画の確認に失敗しました: {str(e)}")
+
+        # 画像キャッシュ
+        st.markdown("画像キャッシュ")
+        image_cache_stats = get_image_cache_stats()
+        lookups = image_cache_stats['hits'] + image_cache_stats['misses']
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            hit_rate = f"{image_cache_stats['hits'] / lookups:.0%}" if lookups else "-"
+            st.metric("ヒット率", hit_rate)
+        with col2:
+            st.metric("ヒット / ミス", f"{image_cache_stats['hits']} / {image_cache_stats['misses']}")
+        with col3:
+            st.metric("追い出し", f"{image_cache_stats['evictions']}件")
+        with col4:
+            st.metric("使用量", f"{image_cache_stats['bytes'] / (1024 * 1024):.1f} / "
+                               f"{image_cache_stats['max_bytes'] / (1024 * 1024):.0f} MB")
+        st.caption(f"キャッシュ中の画像: {image_cache_stats['entries']}件（上限は環境変数 CT_IMAGE_CACHE_MB で変更）")
+
         # 最終バックアップ情報
         st.caption("💡 定期的なバックアップを推奨します（週1回以上）")
 
@@ -2792,16 +4099,8 @@ def show_sidebar():
             
             if st.button("🚪 ログアウト", use_container_width=True):
                 # ログアウト時にセッション情報をクリア
-                if 'user' in st.session_state:
-                    user_id = st.session_state.user['id']
-                    try:
-                        conn = sqlite3.connect('medical_ct.db')
-                        cursor = conn.cursor()
-                        cursor.execute('DELETE FROM user_sessions WHERE user_id = ?', (user_id,))
-                        conn.commit()
-                        conn.close()
-                    except:
-                        pass
+                if st.session_state.get('session_token'):
+                    delete_session_from_db(st.session_state.session_token)
                 for key in list(st.session_state.keys()):
                     del st.session_state[key]
                 st.session_state.page = "welcome"
@@ -2833,32 +4132,25 @@ def show_sidebar():
 # メイン処理
 def main():
     """メイン処理"""
-    # データベース初期化
-    init_database()
-      # 既存ユーザーを一度クリア（一回だけ実行）
-    # conn = sqlite3.connect('medical_ct.db')
-    # cursor = conn.cursor()
-    # cursor.execute("DELETE FROM users")
-    # conn.commit()
-    # conn.close()
-    insert_sample_data()
-    
-
-      # セッション状態の復元（ブラウザ更新対応）
-    if 'user' not in st.session_state:
-        # データベースからセッション情報を復元を試行
-        session_data = load_session_from_db()
-        if session_data:
-            st.session_state.user = session_data['user']
-            st.session_state.page = session_data['page']
-            # デバッグ情報を表示
-    # セッション状態の復元（ブラウザ更新対応）
+    # データベース初期化（未適用のマイグレーションのみ。プロセスごとに一度だけ確認）
+    run_migrations()
+    
+
+    # 以前のバージョンが付けたURLのセッショントークンは使わずに取り除く
+    if LEGACY_SESSION_QUERY_PARAM in st.query_params:
+        del st.query_params[LEGACY_SESSION_QUERY_PARAM]
+
+    # セッション状態の復元（ブラウザ更新対応。Cookieのセッショントークンで復元する）
     if 'user' not in st.session_state:
-        # データベースからセッション情報を復元を試行
-        session_data = load_session_from_db()
+        token = get_session_cookie()
+        session_data = load_session_from_db(token)
         if session_data:
             st.session_state.user = session_data['user']
             st.session_state.page = session_data['page']
+            st.session_state.session_token = token
+
+    # セッションCookieを現在のログイン状態に合わせる
+    sync_session_cookie()
     
     # ページ状態の初期化
     if 'page' not in st.session_state:
@@ -2903,4 +4195,8 @@ def main():
         show_admin_page()
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        # 次の再実行は別のスレッドで動くため、この再実行で借りた接続をプールに返す
+        release_db_connection()